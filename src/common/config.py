@@ -9,9 +9,30 @@ LOCAL_IMAGES_BASE_PATH = "/home/pi/timelapse_data"
 CAMERA_ISO = 200
 INTERVAL_SEC = 60
 SHUTTER_SPEED_PERCENTS = [20, 50, 100, 200, 500]
+# The base exposure. Every bracket policy captures it, so every image series
+# has a frame comparable with all others.
+BASE_SHUTTER_SPEED_PERCENT = 100
+# Append the RAW Bayer data (~10MB) to each JPEG, for post_processor/raw_hdr.py
+CAPTURE_RAW = False
+# White balance gains (red, blue) applied to the RAW HDR merge. The recorder
+# locks the camera's white balance and logs its gains as "camera.awb_gains".
+RAW_AWB_GAINS = (1.5, 1.5)
+
+# Which exposures of SHUTTER_SPEED_PERCENTS to shoot each interval.
+# One of "full", "adaptive", "keyframe". See recorder/bracket_schedule.py
+BRACKET_POLICY = "full"
+# Local time windows (start hour, end hour) where the "keyframe" policy shoots
+# brackets. Keep them around the times the post processor selects.
+KEYFRAME_WINDOWS = [(11.5, 13.5)]
 
 # Viewfinder settings
 DEFAULT_VIEWFINDER_PORT = 80
 
 # Options for post processor
 POST_PROCESSING_PATH = r"/mnt/r/Mirror"
+
+# Time zone and location of the camera. Used for the overlay and for
+# selecting images by local time of day.
+LOCAL_TIME_ZONE = "Asia/Jerusalem"
+LOCATION_LATITUDE = 31.77
+LOCATION_LONGITUDE = 35.21
@@ -2,30 +2,95 @@
 import os
 from pathlib import Path
 import shutil
-from azure.storage.blob import BlobServiceClient
 from common import config
 import time
 import logging
+import hashlib
+import json
+import re
+from typing import Dict, List, Optional
 from common.utils import run_command
 
+# Manifests
+# =========
+# The uploader maintains small JSON blobs listing each image series with its
+# files' shutter values, sizes and MD5 hashes. Readers fetch a few manifests
+# instead of paging through millions of blob listings. A day is sharded into
+# one manifest per (UTC) hour, so the read-modify-write done for every series
+# stays small all day. The day and top-level indexes change only when an hour
+# or a day is added. All are updated with optimistic concurrency (ETag
+# conditions), so concurrent writers never lose updates.
+#
+# When the uploader starts a new day, it closes the previous days: their hour
+# manifests are compacted into the day manifest, and the index records its
+# revision. Readers fetch a closed day with a single GET, and skip it when
+# their local copy has the same revision. Late uploads to a closed day update
+# the day manifest and bump its revision.
+#
+# The index is "complete" if it lists every uploaded image. It isn't when the
+# manifests were started on an existing container, until rebuild_manifests()
+# is run (python3 -m common.storage rebuild-manifests).
+#
+#   <timelapse>/manifests/index.json          {"days": ["2022-05-07", ...],
+#                                              "closed": {day: revision},
+#                                              "complete": true}
+#   <timelapse>/manifests/2022-05-07.json     {"day": ..., "images_prefix": ...,
+#                                              "hours": ["06", "07", ...],
+#                                              closed days: "closed": true,
+#                                              "revision": n, "series": {...}}
+#   <timelapse>/manifests/2022-05-07/07.json  {"series": {name: [file, ...]}}
+MANIFEST_INDEX_NAME = "index.json"
+MANIFEST_UPDATE_RETRIES = 10
+MANIFEST_DOWNLOAD_THREADS = 8
+
+# (manifest prefix, day, hour) already listed in the indexes by this process.
+# Lets the uploader skip reading the indexes for every series.
+_indexed_hours = set()
+
+# Example: '2022-03-26T07-14-29--shutter_050.jpg' --> '050'
+SHUTTER_RE = re.compile(r".+?--shutter_(?P<shutter>\d+?).jpg")
+
+
 # From: https://stackoverflow.com/questions/63413832/upload-local-folder-to-azure-blob-storage-using-blobserviceclient-with-python-v1
 def _upload_file(client, source, dest):
-    with open(source, "rb") as data:
-        client.upload_blob(name=dest, data=data, overwrite=True)
+    # Return the manifest entry of the uploaded file
+    with open(source, "rb") as f:
+        data = f.read()
+    client.upload_blob(name=dest, data=data, overwrite=True)
     logging.info(f"Uploaded: source={source} dest={dest}")
+    entry = {
+        "name": os.path.basename(source),
+        "size": len(data),
+        "md5": hashlib.md5(data).hexdigest(),
+    }
+    m = SHUTTER_RE.match(entry["name"])
+    if m is not None:
+        entry["shutter"] = int(m.group("shutter"))
+    return entry
 
 
-def _upload_dir(client, source, dest, delete):
+def _upload_dir(client, source, dest, delete, manifest_prefix=None):
     prefix = "" if dest == "" else dest + "/"
     for root, dirs, files in list(os.walk(source)):
+        dir_part = os.path.relpath(root, source)
+        dir_part = "" if dir_part == "." else dir_part + "/"
+        entries = []
         for name in files:
-            dir_part = os.path.relpath(root, source)
-            dir_part = "" if dir_part == "." else dir_part + "/"
             file_path = os.path.join(root, name)
             blob_path = prefix + dir_part + name
-            _upload_file(client, file_path, blob_path)
-            if delete:
-                _remove(file_path)
+            entries.append(_upload_file(client, file_path, blob_path))
+
+        # The directory format is day / image_set_name / im*.jpg
+        parts = dir_part.strip("/").split("/")
+        if manifest_prefix is not None and entries and len(parts) == 2:
+            day, series = parts
+            update_day_manifest(client, manifest_prefix, dest, day, {series: entries})
+
+        # Delete only after the manifest is updated. If anything failed, the
+        # whole series is uploaded again on the next attempt.
+        if delete:
+            for name in files:
+                _remove(os.path.join(root, name))
     # if delete:
     #    _remove(source)
 
@@ -58,35 +123,501 @@ def _get_sas_key():
     return key
 
 
-def upload_to_remote_storage(container_name, source, dest, delete):
+class _LocalBlob:
+    def __init__(self, name, data: bytes):
+        self.name = name
+        self.size = len(data)
+        self.etag = hashlib.md5(data).hexdigest()
+        self.content_settings = _LocalContentSettings(hashlib.md5(data).digest())
+
+
+class _LocalContentSettings:
+    def __init__(self, content_md5):
+        self.content_md5 = content_md5
+
+
+class _LocalDownloader:
+    def __init__(self, blob: _LocalBlob, data: bytes):
+        self.properties = blob
+        self._data = data
+
+    def readall(self):
+        return self._data
+
+
+class LocalContainerClient:
+    """A stand-in for azure ContainerClient, backed by a local directory.
+
+    Implements the subset used here, including ETag conditions, and raises
+    the same azure exceptions. Select it by setting TIMELAPSE_LOCAL_CONTAINER_DIR.
+    For tests against a real service API, point the connection string at Azurite.
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def _read(self, name):
+        from azure.core.exceptions import ResourceNotFoundError
+
+        path = self.root / name
+        if not path.is_file():
+            raise ResourceNotFoundError(f"Blob not found: {name}")
+        data = path.read_bytes()
+        return _LocalBlob(name, data), data
+
+    def upload_blob(self, name, data, overwrite=False, etag=None, match_condition=None):
+        from azure.core.exceptions import ResourceExistsError, ResourceModifiedError
+
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        elif not isinstance(data, bytes):
+            data = data.read()
+        path = self.root / name
+        if path.exists():
+            if not overwrite:
+                raise ResourceExistsError(f"Blob exists: {name}")
+            if etag is not None and self._read(name)[0].etag != etag:
+                raise ResourceModifiedError(f"Blob was modified: {name}")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_bytes(data)
+        tmp_path.replace(path)
+
+    def download_blob(self, blob):
+        name = blob if isinstance(blob, str) else blob.name
+        return _LocalDownloader(*self._read(name))
+
+    def list_blobs(self, name_starts_with=None):
+        prefix = name_starts_with or ""
+        names = sorted(
+            p.relative_to(self.root).as_posix()
+            for p in self.root.rglob("*")
+            if p.is_file()
+        )
+        return [self._read(n)[0] for n in names if n.startswith(prefix)]
+
+
+def _get_container_client(container_name):
+    local_dir = os.getenv("TIMELAPSE_LOCAL_CONTAINER_DIR")
+    if local_dir:
+        return LocalContainerClient(Path(local_dir) / container_name)
+
+    # Import the Azure SDK lazily. It is slow to load on the Pi and is not
+    # needed by consumers that only call sync_files (which shells out to azcopy).
+    from azure.storage.blob import BlobServiceClient
+
     connect_str = _get_connection_string()
     service_client = BlobServiceClient.from_connection_string(connect_str)
-    client = service_client.get_container_client(container_name)
-    _upload_dir(client, source=source, dest=dest, delete=delete)
+    return service_client.get_container_client(container_name)
+
+
+def _read_json_blob(client, blob_name):
+    # Return the parsed blob and its ETag, or (None, None) if it does not exist
+    from azure.core.exceptions import ResourceNotFoundError
+
+    try:
+        downloader = client.download_blob(blob_name)
+        return json.loads(downloader.readall()), downloader.properties.etag
+    except ResourceNotFoundError:
+        return None, None
+
+
+def _update_json_blob(client, blob_name, update):
+    # Read-modify-write a JSON blob atomically. `update` takes the current
+    # content (None if the blob doesn't exist) and returns the new content, or
+    # None if there is nothing to change. On a concurrent modification, re-read
+    # and try again. Returns the content after the update.
+    from azure.core import MatchConditions
+    from azure.core.exceptions import ResourceExistsError, ResourceModifiedError
+
+    for _ in range(MANIFEST_UPDATE_RETRIES):
+        content, etag = _read_json_blob(client, blob_name)
+        new_content = update(content)
+        if new_content is None:
+            return content
+        data = json.dumps(new_content, separators=(",", ":"), sort_keys=True)
+        try:
+            if etag is None:
+                client.upload_blob(name=blob_name, data=data, overwrite=False)
+            else:
+                client.upload_blob(
+                    name=blob_name,
+                    data=data,
+                    overwrite=True,
+                    etag=etag,
+                    match_condition=MatchConditions.IfNotModified,
+                )
+            logging.debug(f"Updated: {blob_name}")
+            return new_content
+        except (ResourceExistsError, ResourceModifiedError):
+            logging.info(f"Concurrent update of {blob_name}. Retrying")
+    raise Exception(f"Failed to update {blob_name}")
+
+
+def _series_hour(series: str) -> str:
+    # Series names are UTC times. E.g. 2022-03-26T07-14-29 --> '07'
+    return series[11:13]
+
+
+def _update_hour_manifest(
+    client, manifest_prefix: str, day: str, hour: str, series: Dict[str, List[Dict]]
+):
+    def _update_hour(manifest):
+        if manifest is None:
+            manifest = {"series": {}}
+        for name, entries in series.items():
+            manifest["series"][name] = sorted(entries, key=lambda x: x["name"])
+        return manifest
+
+    _update_json_blob(client, f"{manifest_prefix}/{day}/{hour}.json", _update_hour)
+
+
+def _update_day_index(
+    client,
+    manifest_prefix: str,
+    images_prefix: str,
+    day: str,
+    series: Dict[str, List[Dict]],
+) -> Dict:
+    # Add the hours of some series to the day manifest. If the day is closed,
+    # this is a late upload: add the series to the compacted manifest too.
+    hours = {_series_hour(name) for name in series}
+
+    def _update_day(manifest):
+        if manifest is None:
+            manifest = {"day": day, "images_prefix": images_prefix, "hours": []}
+        if hours <= set(manifest["hours"]) and not manifest.get("closed"):
+            return None
+        manifest["hours"] = sorted(set(manifest["hours"]) | hours)
+        if manifest.get("closed"):
+            for name, entries in series.items():
+                manifest["series"][name] = sorted(entries, key=lambda x: x["name"])
+            manifest["revision"] += 1
+        return manifest
+
+    return _update_json_blob(client, f"{manifest_prefix}/{day}.json", _update_day)
+
+
+def _has_older_images(client, images_prefix: str, day: str) -> bool:
+    # True if the container has images of days before `day`. Blobs are listed
+    # in name order, so the first one is enough.
+    for blob in client.list_blobs(name_starts_with=images_prefix + "/"):
+        return blob.name[len(images_prefix) + 1 :] < day
+    return False
+
+
+def _update_index(
+    client,
+    manifest_prefix: str,
+    images_prefix: str,
+    days: List[str],
+    revisions: Optional[Dict[str, int]] = None,
+    complete: bool = False,
+) -> Dict:
+    # Add days and closed day revisions to the index
+    revisions = revisions or {}
+
+    def _update_index(index):
+        if index is None:
+            # A new index lists every image, unless images were uploaded
+            # before the manifests existed
+            index = {
+                "days": [],
+                "closed": {},
+                "complete": not _has_older_images(client, images_prefix, min(days)),
+            }
+        new_days = set(days) - set(index["days"])
+        new_revisions = {
+            day: revision
+            for day, revision in revisions.items()
+            if revision > index["closed"].get(day, 0)
+        }
+        if not new_days and not new_revisions and index["complete"] >= complete:
+            return None
+        index["days"] = sorted(set(index["days"]) | new_days)
+        index["closed"].update(new_revisions)
+        index["complete"] = index["complete"] or complete
+        return index
+
+    return _update_json_blob(
+        client, f"{manifest_prefix}/{MANIFEST_INDEX_NAME}", _update_index
+    )
+
+
+def _closed_revisions(day_manifests: List[Dict]) -> Dict[str, int]:
+    return {x["day"]: x["revision"] for x in day_manifests if x.get("closed")}
+
+
+def _close_day(client, manifest_prefix: str, images_prefix: str, day: str):
+    # Compact the hour manifests of a day into its day manifest
+    def _update_day(manifest):
+        if manifest is None or manifest.get("closed"):
+            return None
+        manifest["series"] = {}
+        for hour in manifest["hours"]:
+            manifest["series"].update(
+                read_hour_manifest(client, manifest_prefix, day, hour)
+            )
+        manifest["closed"] = True
+        manifest["revision"] = 1
+        return manifest
+
+    manifest = _update_json_blob(client, f"{manifest_prefix}/{day}.json", _update_day)
+    _update_index(
+        client, manifest_prefix, images_prefix, [day], _closed_revisions([manifest])
+    )
+    # Late uploads to this day must update the closed manifest
+    for key in [x for x in _indexed_hours if x[:2] == (manifest_prefix, day)]:
+        _indexed_hours.discard(key)
+    logging.info(f"Closed the manifest of {day}")
+
+
+def _close_days_before(client, manifest_prefix, images_prefix, index, day):
+    for old_day in index["days"]:
+        if old_day < day and old_day not in index["closed"]:
+            _close_day(client, manifest_prefix, images_prefix, old_day)
+
+
+def _write_day_manifests(
+    client,
+    manifest_prefix: str,
+    images_prefix: str,
+    day: str,
+    series: Dict[str, List[Dict]],
+    skip_indexed: bool = False,
+) -> Optional[Dict]:
+    # Write the hour manifests of some series of a day, and update the day
+    # manifest. With skip_indexed, hours that this process already added are
+    # not looked up again. Returns the day manifest, or None if skipped.
+    by_hour = {}
+    for name, entries in series.items():
+        by_hour.setdefault(_series_hour(name), {})[name] = entries
+    for hour, hour_series in sorted(by_hour.items()):
+        _update_hour_manifest(client, manifest_prefix, day, hour, hour_series)
+
+    keys = {(manifest_prefix, day, hour) for hour in by_hour}
+    if skip_indexed and keys <= _indexed_hours:
+        return None
+    return _update_day_index(client, manifest_prefix, images_prefix, day, series)
+
+
+def update_day_manifest(
+    client,
+    manifest_prefix: str,
+    images_prefix: str,
+    day: str,
+    series: Dict[str, List[Dict]],
+):
+    """Record the files of some image series of a day (series name -> entries)."""
+    manifest = _write_day_manifests(
+        client, manifest_prefix, images_prefix, day, series, skip_indexed=True
+    )
+    if manifest is None:
+        return
+    index = _update_index(
+        client, manifest_prefix, images_prefix, [day], _closed_revisions([manifest])
+    )
+    if not manifest.get("closed"):
+        _indexed_hours.update(
+            (manifest_prefix, day, _series_hour(name)) for name in series
+        )
+    # Earlier days get no more uploads, except late ones
+    _close_days_before(client, manifest_prefix, images_prefix, index, day)
+
+
+def get_manifest_prefix(timelapse_name: str):
+    return f"{timelapse_name}/manifests"
+
+
+def read_manifest_index(client, manifest_prefix: str) -> Optional[Dict]:
+    index, _ = _read_json_blob(client, f"{manifest_prefix}/{MANIFEST_INDEX_NAME}")
+    return index
+
+
+def read_hour_manifest(client, manifest_prefix: str, day: str, hour: str) -> Dict:
+    # Return the series of one hour of a day: {name: [file, ...]}
+    manifest, _ = _read_json_blob(client, f"{manifest_prefix}/{day}/{hour}.json")
+    return {} if manifest is None else manifest["series"]
+
+
+def read_day_manifest(client, manifest_prefix: str, day: str) -> Optional[Dict]:
+    # Return the day manifest with the series of all its hours, under "series"
+    manifest, _ = _read_json_blob(client, f"{manifest_prefix}/{day}.json")
+    if manifest is None or manifest.get("closed"):
+        return manifest
+    manifest["series"] = {}
+    for hour in manifest["hours"]:
+        manifest["series"].update(
+            read_hour_manifest(client, manifest_prefix, day, hour)
+        )
+    return manifest
+
+
+def rebuild_manifests(container_name: str, timelapse_name: str):
+    # One-off backfill of the manifests of blobs uploaded before manifests
+    # existed. This lists the whole container once, then writes each manifest
+    # once and closes all days but the last. Hashes come from the blobs'
+    # Content-MD5, which the service sets on single-shot uploads.
+    client = _get_container_client(container_name)
+    images_prefix = f"{timelapse_name}/images"
+    manifest_prefix = get_manifest_prefix(timelapse_name)
+    by_day = {}
+    for blob in client.list_blobs(name_starts_with=images_prefix + "/"):
+        parts = blob.name[len(images_prefix) + 1 :].split("/")
+        if len(parts) != 3:
+            continue
+        day, series, name = parts
+        entry = {"name": name, "size": blob.size}
+        md5 = blob.content_settings.content_md5
+        if md5:
+            entry["md5"] = bytes(md5).hex()
+        m = SHUTTER_RE.match(name)
+        if m is not None:
+            entry["shutter"] = int(m.group("shutter"))
+        by_day.setdefault(day, {}).setdefault(series, []).append(entry)
+    if not by_day:
+        return
+
+    manifests = [
+        _write_day_manifests(client, manifest_prefix, images_prefix, day, series)
+        for day, series in sorted(by_day.items())
+    ]
+    index = _update_index(
+        client,
+        manifest_prefix,
+        images_prefix,
+        sorted(by_day),
+        _closed_revisions(manifests),
+        complete=True,
+    )
+    _close_days_before(client, manifest_prefix, images_prefix, index, index["days"][-1])
+
+
+def upload_to_remote_storage(
+    container_name, source, dest, delete, manifest_prefix: Optional[str] = None
+):
+    client = _get_container_client(container_name)
+    _upload_dir(
+        client,
+        source=source,
+        dest=dest,
+        delete=delete,
+        manifest_prefix=manifest_prefix,
+    )
 
 
 def get_latest_files(container_name, day):
-    connect_str = _get_connection_string()
-    service_client = BlobServiceClient.from_connection_string(connect_str)
-    client = service_client.get_container_client(container_name)
-    if day is not None:
-        start_with = f"{config.TIMELAPSE_NAME}/images/{day}"
+    client = _get_container_client(container_name)
+    manifest_prefix = get_manifest_prefix(config.TIMELAPSE_NAME)
     last_dl = None
     while True:
-        blobs = client.list_blobs(name_starts_with=start_with)
-        blobs = list(blobs)
-        blobs.sort(key=lambda b: b.name)
+        # Read the latest hour's manifest instead of listing the day's blobs
+        latest_day = day or read_manifest_index(client, manifest_prefix)["days"][-1]
+        manifest, _ = _read_json_blob(client, f"{manifest_prefix}/{latest_day}.json")
+        hour_series = read_hour_manifest(
+            client, manifest_prefix, latest_day, manifest["hours"][-1]
+        )
+        series = max(hour_series)
+        latest_file = hour_series[series][-1]["name"]
+        blob_name = f"{manifest['images_prefix']}/{latest_day}/{series}/{latest_file}"
 
-        print(blobs[-1].name)
-        if last_dl != blobs[-1].name:
+        print(blob_name)
+        if last_dl != blob_name:
             download_file_path = "/tmp/dl.jpg"
             with open(download_file_path, "wb") as download_file:
-                dl = client.download_blob(blobs[-1]).readall()
+                dl = client.download_blob(blob_name).readall()
                 download_file.write(dl)
-                last_dl = blobs[-1].name
+                last_dl = blob_name
         time.sleep(1)
 
 
+def _download_blob(client, blob_name: str, out_file: Path):
+    out_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = out_file.with_name(out_file.name + ".tmp")
+    with open(tmp_file, "wb") as f:
+        f.write(client.download_blob(blob_name).readall())
+    tmp_file.replace(out_file)
+    logging.info(f"Downloaded: {blob_name}")
+
+
+def download_from_manifests(
+    container_name: str, date_prefix: str, dst_dir: Path
+) -> bool:
+    # Download the files listed in the manifests that are missing locally (or
+    # differ in size). Uses the connection string, like the uploader. Closed
+    # days are skipped if they were fully downloaded at the same revision.
+    # Returns True if the manifests list every uploaded image.
+    from concurrent.futures import ThreadPoolExecutor
+
+    client = _get_container_client(container_name)
+    manifest_prefix = get_manifest_prefix(config.TIMELAPSE_NAME)
+    index = read_manifest_index(client, manifest_prefix)
+    if index is None:
+        return False
+
+    # Local copies of the closed day manifests that were fully downloaded
+    local_manifest_dir = dst_dir / manifest_prefix
+
+    def _is_downloaded(day):
+        local_path = local_manifest_dir / f"{day}.json"
+        if day not in index["closed"] or not local_path.exists():
+            return False
+        with open(local_path, "rt") as f:
+            return json.load(f)["revision"] == index["closed"][day]
+
+    days = [
+        day
+        for day in index["days"]
+        if day.startswith(date_prefix) and not _is_downloaded(day)
+    ]
+    with ThreadPoolExecutor(max_workers=MANIFEST_DOWNLOAD_THREADS) as executor:
+        manifests = list(
+            executor.map(
+                lambda day: read_day_manifest(client, manifest_prefix, day), days
+            )
+        )
+        futures = []
+        for manifest in manifests:
+            day = manifest["day"]
+            images_prefix = manifest["images_prefix"]
+            for series, entries in manifest["series"].items():
+                for entry in entries:
+                    blob_name = f"{images_prefix}/{day}/{series}/{entry['name']}"
+                    out_file = dst_dir / blob_name
+                    if out_file.exists() and out_file.stat().st_size == entry["size"]:
+                        continue
+                    futures.append(
+                        executor.submit(_download_blob, client, blob_name, out_file)
+                    )
+        # Raise the first error, if any
+        for future in futures:
+            future.result()
+
+    local_manifest_dir.mkdir(parents=True, exist_ok=True)
+    for manifest in manifests:
+        if manifest.get("closed"):
+            with open(local_manifest_dir / f"{manifest['day']}.json", "wt") as f:
+                json.dump(manifest, f)
+    return index["complete"]
+
+
+def download_images(container_name: str, date_prefix: str, dst_dir: Path):
+    # Download new images. Use the manifests if there is a connection string.
+    # Fall back to azcopy sync with the SAS key if there isn't, or if the
+    # manifests don't list every image yet.
+    if os.getenv("TIMELAPSE_AZURE_STORAGE_CONNECTION_STRING") or os.getenv(
+        "TIMELAPSE_LOCAL_CONTAINER_DIR"
+    ):
+        if download_from_manifests(container_name, date_prefix, dst_dir):
+            return
+        logging.warning(
+            "The manifests don't list images uploaded before they existed. "
+            "Falling back to azcopy sync. Run 'python3 -m common.storage "
+            "rebuild-manifests' once to fix this"
+        )
+    sync_files(container_name, date_prefix, dst_dir, overwrite=False)
+
+
 def sync_files(container_name: str, date_prefix: str, dst_dir: Path, overwrite: bool):
     # Download files from source to destination. Delete files in the distination that that are not present in the source.
     sas_key = _get_sas_key()
@@ -97,3 +628,28 @@ def sync_files(container_name: str, date_prefix: str, dst_dir: Path, overwrite:
     overwrite_str = "true" if overwrite else "false"
     cmd = rf'azcopy sync "{url}?{sas_key}" "{str(dst_dir2)}"  --include-pattern "{date_prefix}*"  --delete-destination false'
     run_command(cmd)
+
+
+def main():
+    import argparse
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild = subparsers.add_parser(
+        "rebuild-manifests",
+        help="List the container once and write the manifests of all its images",
+    )
+    rebuild.add_argument("--container", default=config.CONTAINER_NAME)
+    rebuild.add_argument("--timelapse", default=config.TIMELAPSE_NAME)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "rebuild-manifests":
+        rebuild_manifests(args.container, args.timelapse)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 import subprocess
 import logging
-
+from functools import lru_cache
 
 FULL_WIDTH = 3280
 FULL_HEIGHT = 2464
@@ -23,6 +23,16 @@ def capture_raspistill_method(dst_dir, time_str):
         capture_still(out_file, ev=ev)
 
 
+@lru_cache(maxsize=None)
+def get_time_zone(name: str):
+    from dateutil import tz
+
+    zone = tz.gettz(name)
+    if zone is None:
+        raise Exception(f"Unknown time zone: {name}")
+    return zone
+
+
 # Run command and show its stdout in real time
 # Throw if error
 def run_command(cmd, print_output: bool = True):
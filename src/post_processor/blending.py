@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+# Streaming accumulators for temporal blending
+# ============================================
+# Blend many frames into one without holding them in memory. Frames are added
+# one at a time. The mean keeps a single frame-sized sum. An exact median needs
+# all the frames, so the median keeps them in a temporary file and reads them
+# back one band of rows at a time.
+import tempfile
+from typing import Optional
+
+import numpy as np
+
+
+class RunningMean:
+    """Per-pixel mean. uint8 frames are summed exactly in a uint32 buffer,
+    other frames in float32."""
+
+    name = "mean"
+
+    def __init__(self):
+        self.count = 0
+        self._sum: Optional[np.ndarray] = None
+        self._dtype = None
+
+    def add(self, img: np.ndarray):
+        if self._sum is None:
+            self._dtype = img.dtype
+            acc_dtype = np.uint32 if img.dtype == np.uint8 else np.float32
+            self._sum = np.zeros(img.shape, dtype=acc_dtype)
+        self._sum += img
+        self.count += 1
+
+    def result(self) -> np.ndarray:
+        assert self.count > 0, "No frames were added"
+        mean = self._sum / np.float32(self.count)
+        if self._dtype == np.uint8:
+            return np.round(mean).astype(np.uint8)
+        return mean.astype(np.float32)
+
+
+class RunningMedian:
+    """Exact per-pixel median with bounded memory.
+
+    Frames are appended to a temporary file as they are added (disk usage is
+    the size of all the frames). result() memory-maps them and computes the
+    median one band of rows at a time, so memory stays around `max_tile_bytes`
+    regardless of the number of frames.
+    """
+
+    name = "median"
+
+    def __init__(self, max_tile_bytes: int = 64 * 2**20, tmp_dir=None):
+        self.max_tile_bytes = max_tile_bytes
+        self.tmp_dir = tmp_dir
+        self.count = 0
+        self._file = None
+        self._shape = None
+        self._dtype = None
+
+    def add(self, img: np.ndarray):
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix="median", dir=self.tmp_dir)
+            self._shape = img.shape
+            self._dtype = img.dtype
+        assert img.shape == self._shape, "All frames must have the same shape"
+        self._file.write(np.ascontiguousarray(img, dtype=self._dtype).tobytes())
+        self.count += 1
+
+    def result(self) -> np.ndarray:
+        assert self.count > 0, "No frames were added"
+        self._file.flush()
+        frames = np.memmap(
+            self._file, dtype=self._dtype, mode="r", shape=(self.count, *self._shape)
+        )
+        out_dtype = np.uint8 if self._dtype == np.uint8 else np.float32
+        out = np.empty(self._shape, dtype=out_dtype)
+
+        # np.median works in float64. Size the bands of rows to fit the budget.
+        row_bytes = self.count * (frames[0, 0].size * 8)
+        rows = max(1, self.max_tile_bytes // row_bytes)
+        for y in range(0, self._shape[0], rows):
+            median = np.median(frames[:, y : y + rows], axis=0)
+            if out_dtype == np.uint8:
+                median = np.round(median)
+            out[y : y + rows] = median
+        del frames
+        return out
+
+
+def create_accumulator(method: str):
+    if method == "mean":
+        return RunningMean()
+    if method == "median":
+        return RunningMedian()
+    raise Exception(f"Unknown blend method: {method}")
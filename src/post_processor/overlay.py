@@ -0,0 +1,253 @@
+#!/usr/bin/python3
+# Overlay compositor
+# ==================
+# Draws the timestamp and other indicators on the output frames.
+#
+# Per-frame cost is kept small and constant:
+#   - The time zone is resolved once, and timestamps are converted for the
+#     whole frame list at once (prepare()).
+#   - Element values (label text, year progress, sun elevation) are
+#     precomputed for all frames in prepare().
+#   - Text is rendered into a small mask of its region of interest and
+#     blended with 8-bit integer math. Only that ROI of the frame is touched.
+from typing import Dict, List, Optional, Sequence
+
+import cv2
+import numpy as np
+import common.config as config
+from common.utils import get_time_zone
+
+# Image set names are UTC times in this format. E.g. 2022-03-26T07-14-29
+SERIES_TIME_FORMAT = "%Y-%m-%dT%H-%M-%S"
+
+
+def compute_local_times(names: Sequence[str], tz_name: str = config.LOCAL_TIME_ZONE):
+    # Parse image set names (UTC) and convert them to the local time zone, for
+    # all names at once. Returns a pandas DatetimeIndex in the local time zone.
+    import pandas as pd
+
+    utc = pd.to_datetime(list(names), format=SERIES_TIME_FORMAT, utc=True)
+    return utc.tz_convert(get_time_zone(tz_name))
+
+
+class OutlinedText:
+    """Draws white text with a black outline, like the original overlay.
+
+    The label is rendered with cv2.putText into a small uint8 mask, and the
+    outline is that mask dilated. Both are blended into the label's region of
+    interest only, with 8-bit integer math.
+    """
+
+    def __init__(
+        self,
+        font=cv2.FONT_HERSHEY_SIMPLEX,
+        font_scale: float = 0.5,
+        thickness: int = 1,
+        outline_width: int = 2,
+    ):
+        self.font = font
+        self.font_scale = font_scale
+        self.thickness = thickness
+        self.pad = outline_width + 1
+        self.kernel = cv2.getStructuringElement(
+            cv2.MORPH_ELLIPSE, (2 * outline_width + 1, 2 * outline_width + 1)
+        )
+
+    def draw(self, img: np.ndarray, text: str, org, color=(255, 255, 255)):
+        # org is the bottom-left corner of the text baseline, as in cv2.putText
+        (w, h), baseline = cv2.getTextSize(
+            text, self.font, self.font_scale, self.thickness
+        )
+        x = org[0] - self.pad
+        y = org[1] - h - self.pad
+        x0, y0 = max(x, 0), max(y, 0)
+        x1 = min(x + w + 2 * self.pad, img.shape[1])
+        y1 = min(y + h + baseline + 2 * self.pad, img.shape[0])
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        fill = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        cv2.putText(
+            fill,
+            text,
+            (org[0] - x0, org[1] - y0),
+            self.font,
+            self.font_scale,
+            255,
+            self.thickness,
+            cv2.LINE_AA,
+        )
+        outline = cv2.dilate(fill, self.kernel)
+
+        # roi = roi * (1 - outline) * (1 - fill) + color * fill
+        keep = cv2.multiply(
+            cv2.bitwise_not(outline), cv2.bitwise_not(fill), scale=1 / 255
+        )
+        roi = img[y0:y1, x0:x1]
+        # cv2.multiply needs both operands of the same type. Like cv2.putText,
+        # this draws the color as is on frames of any depth.
+        fill = cv2.cvtColor(fill, cv2.COLOR_GRAY2BGR).astype(roi.dtype, copy=False)
+        keep = cv2.cvtColor(keep, cv2.COLOR_GRAY2BGR).astype(roi.dtype, copy=False)
+        cv2.add(
+            cv2.multiply(roi, keep, scale=1 / 255),
+            cv2.multiply(fill, (*color, 0), scale=1 / 255),
+            dst=roi,
+        )
+
+
+class OverlayElement:
+    """Something drawn on every frame.
+
+    values() is called once with the names and local times of all frames, so
+    that elements can precompute what they draw in a vectorized way. draw()
+    then gets the value of one frame.
+    """
+
+    def values(self, names: Sequence[str], local_times) -> Sequence:
+        raise Exception("Not implemented")
+
+    def draw(self, img: np.ndarray, value):
+        raise Exception("Not implemented")
+
+
+class TimestampText(OverlayElement):
+    def __init__(self, org=(10, 20)):
+        self.text = OutlinedText()
+        self.org = org
+
+    def values(self, names, local_times):
+        return [f"{name}     {t}" for name, t in zip(names, local_times)]
+
+    def draw(self, img, value):
+        self.text.draw(img, value, self.org)
+
+
+class YearProgressBar(OverlayElement):
+    """A thin bar that fills up over the calendar year."""
+
+    def __init__(self, org=(10, 30), size=(200, 6)):
+        self.org = org
+        self.size = size
+
+    def values(self, names, local_times):
+        days_in_year = np.where(local_times.is_leap_year, 366, 365)
+        day = local_times.dayofyear - 1 + local_times.hour / 24.0
+        return np.asarray(day / days_in_year)
+
+    def draw(self, img, value):
+        x, y = self.org
+        w, h = self.size
+        filled = int(round(value * w))
+        cv2.rectangle(img, (x, y), (x + w, y + h), (0, 0, 0), -1)
+        cv2.rectangle(img, (x, y), (x + filled, y + h), (255, 255, 255), -1)
+
+
+def compute_sun_elevation(utc_times, latitude: float, longitude: float):
+    # Approximate solar elevation in degrees (NOAA general solar position
+    # equations). Vectorized over a pandas DatetimeIndex in any time zone.
+    utc_times = utc_times.tz_convert("UTC")
+    hours = np.asarray(
+        utc_times.hour + utc_times.minute / 60.0 + utc_times.second / 3600.0
+    )
+    doy = np.asarray(utc_times.dayofyear)
+    days_in_year = np.where(utc_times.is_leap_year, 366, 365)
+    g = 2 * np.pi / days_in_year * (doy - 1 + (hours - 12) / 24)
+    decl = (
+        0.006918
+        - 0.399912 * np.cos(g)
+        + 0.070257 * np.sin(g)
+        - 0.006758 * np.cos(2 * g)
+        + 0.000907 * np.sin(2 * g)
+        - 0.002697 * np.cos(3 * g)
+        + 0.00148 * np.sin(3 * g)
+    )
+    eqtime = 229.18 * (
+        0.000075
+        + 0.001868 * np.cos(g)
+        - 0.032077 * np.sin(g)
+        - 0.014615 * np.cos(2 * g)
+        - 0.040849 * np.sin(2 * g)
+    )
+    true_solar_minutes = hours * 60 + eqtime + 4 * longitude
+    hour_angle = np.radians(true_solar_minutes / 4 - 180)
+    lat = np.radians(latitude)
+    cos_zenith = np.sin(lat) * np.sin(decl) + np.cos(lat) * np.cos(decl) * np.cos(
+        hour_angle
+    )
+    return 90 - np.degrees(np.arccos(np.clip(cos_zenith, -1, 1)))
+
+
+class SunElevationIndicator(OverlayElement):
+    """A small box with a dot at the height of the sun above the horizon."""
+
+    def __init__(
+        self,
+        latitude: float = config.LOCATION_LATITUDE,
+        longitude: float = config.LOCATION_LONGITUDE,
+        org=(220, 26),
+        size=(14, 40),
+    ):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.org = org
+        self.size = size
+
+    def values(self, names, local_times):
+        return compute_sun_elevation(local_times, self.latitude, self.longitude)
+
+    def draw(self, img, value):
+        x, y = self.org
+        w, h = self.size
+        # Map elevation -30..90 degrees to the box height
+        horizon_y = y + int(h * 90 / 120)
+        elevation = np.clip(value, -30, 90)
+        sun_y = y + int(round(h * (90 - elevation) / 120))
+        cv2.rectangle(img, (x, y), (x + w, y + h), (0, 0, 0), -1)
+        cv2.line(img, (x, horizon_y), (x + w, horizon_y), (128, 128, 128), 1)
+        color = (0, 215, 255) if elevation > 0 else (128, 128, 128)
+        cv2.circle(img, (x + w // 2, sun_y), 3, color, -1)
+
+
+OVERLAY_ELEMENTS = ["timestamp", "year_progress", "sun_elevation"]
+
+
+class OverlayCompositor:
+    """Draw overlay elements on frames named after their image set."""
+
+    def __init__(
+        self,
+        elements: Optional[List[str]] = None,
+        tz_name: str = config.LOCAL_TIME_ZONE,
+    ):
+        self.tz_name = tz_name
+        factories = {
+            "timestamp": TimestampText,
+            "year_progress": YearProgressBar,
+            "sun_elevation": SunElevationIndicator,
+        }
+        elements = ["timestamp"] if elements is None else elements
+        self.elements = [factories[x]() for x in elements]
+        # Per-frame element values, by frame name
+        self._prepared: Dict[str, tuple] = {}
+        self._unprepared: Dict[str, tuple] = {}
+
+    def _compute_values(self, names: List[str]) -> Dict[str, tuple]:
+        local_times = compute_local_times(names, self.tz_name)
+        columns = [element.values(names, local_times) for element in self.elements]
+        return {name: tuple(c[i] for c in columns) for i, name in enumerate(names)}
+
+    def prepare(self, names: Sequence[str]):
+        # Convert all timestamps at once and let elements precompute their values
+        self._prepared = self._compute_values(list(names))
+
+    def draw(self, img: np.ndarray, name: str):
+        values = self._prepared.get(name)
+        if values is None:
+            # Not prepared in advance. Compute just this frame and keep it
+            # apart, so the prepared table stays intact.
+            values = self._unprepared.get(name)
+            if values is None:
+                values = self._compute_values([name])[name]
+                self._unprepared[name] = values
+        for element, value in zip(self.elements, values):
+            element.draw(img, value)
@@ -1,10 +1,13 @@
 #!/usr/bin/python3
 import logging
-from typing import List, Optional
+from typing import TYPE_CHECKING, List, Optional
 from tqdm import tqdm
-from common.storage import sync_files
+from common.storage import download_images
 from pathlib import Path
-import pandas as pd
+
+# cv2 is needed by every run: all transformers decode frames, and every output
+# frame is encoded and gets an overlay. Optional stages (stabilization,
+# blending, RAW HDR) are imported where they are used.
 import cv2
 import common.settings as settings
 import re
@@ -12,11 +15,17 @@ import numpy as np
 import tempfile
 from dataclasses import dataclass
 from common.utils import run_command
-import datetime
-from dateutil import tz
-import dask.distributed as dd
 import common.config as config
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from post_processor.overlay import (
+    OVERLAY_ELEMENTS,
+    OverlayCompositor,
+    compute_local_times,
+)
+
+if TYPE_CHECKING:
+    from post_processor.stabilization import Stabilizer
 
 
 @dataclass
@@ -32,6 +41,14 @@ class ImageSet:
     name: str
     files: List[ImageFile]
 
+    def center_file(self) -> ImageFile:
+        # The base exposure, which the recorder captures in every set.
+        # Fall back to the middle of the bracket.
+        for image_file in self.files:
+            if image_file.shutter == config.BASE_SHUTTER_SPEED_PERCENT:
+                return image_file
+        return self.files[len(self.files) // 2]
+
 
 # Image set transformers functions take an image set and return a transformed image
 class ImageSetTransformer:
@@ -48,6 +65,11 @@ class HdrTransformer(ImageSetTransformer):
         super().__init__(f"hdr_{self.hdr_method}")
 
     def transform(self, image_set: ImageSet):
+        if len(image_set.files) == 1:
+            # Not bracketed (see the recorder's bracket policies)
+            img = cv2.imread(str(image_set.files[0].src_path))
+            assert img is not None
+            return img
         paths = [x.src_path for x in image_set.files]
         with tempfile.NamedTemporaryFile(prefix="hdr", suffix=".bmp") as tmpf:
             create_hdr(paths, Path(tmpf.name), method=self.hdr_method)
@@ -56,17 +78,87 @@ class HdrTransformer(ImageSetTransformer):
             return img
 
 
+class RawHdrTransformer(ImageSetTransformer):
+    """HDR merged linearly from the RAW Bayer data appended to the JPEGs.
+
+    Needs images captured with RAW (config.CAPTURE_RAW or raspistill --raw).
+    The merged radiance map is tone mapped with luminance-hdr-cli.
+    """
+
+    def __init__(self, tmo_method: str):
+        self.tmo_method = tmo_method
+        super().__init__(f"raw_hdr_{self.tmo_method}")
+
+    def transform(self, image_set: ImageSet):
+        from post_processor.raw_hdr import merge_image_set
+
+        hdr = merge_image_set(image_set.files)
+        with tempfile.TemporaryDirectory(prefix="raw_hdr") as tmp_dir:
+            hdr_file = Path(tmp_dir) / "merged.hdr"
+            out_file = Path(tmp_dir) / "tonemapped.bmp"
+            if not cv2.imwrite(str(hdr_file), hdr):
+                raise Exception(f"Failed to write {hdr_file}")
+            tonemap_hdr_file(hdr_file, out_file, method=self.tmo_method)
+            img = cv2.imread(str(out_file))
+            assert img is not None
+            return img
+
+
 class TakeCenterBracketImage(ImageSetTransformer):
     def __init__(self):
         super().__init__("center_bracket")
 
     def transform(self, image_set: ImageSet):
-        ind = len(image_set.files) // 2
-        img = cv2.imread(str(image_set.files[ind].src_path))
+        img = cv2.imread(str(image_set.center_file().src_path))
         assert img is not None
         return img
 
 
+class TemporalBlendTransformer(ImageSetTransformer):
+    """Blend several image sets (e.g. a whole day) into one frame.
+
+    Each image set is turned into a frame by `frame_transformer`, optionally
+    stabilized, and added to a streaming accumulator. Only one decoded frame
+    is held in memory at a time. The daily window (local hours) is part of the
+    name, so outputs of different windows don't mix.
+    """
+
+    def __init__(
+        self,
+        frame_transformer: ImageSetTransformer,
+        method: str,
+        start_hour: float,
+        end_hour: float,
+        stabilizer: Optional["Stabilizer"] = None,
+    ):
+        self.frame_transformer = frame_transformer
+        self.method = method
+        self.start_hour = start_hour
+        self.end_hour = end_hour
+        self.stabilizer = stabilizer
+        super().__init__(
+            f"blend_{method}_{start_hour:g}-{end_hour:g}h_{frame_transformer.name}"
+        )
+
+    def blend(self, image_sets: List[ImageSet]) -> np.ndarray:
+        from post_processor.blending import create_accumulator
+        from post_processor.stabilization import apply_transform
+
+        accumulator = create_accumulator(self.method)
+        for image_set in image_sets:
+            img = self.frame_transformer.transform(image_set)
+            if self.stabilizer is not None:
+                transform = self.stabilizer.get_transform(
+                    image_set.name, get_registration_path(image_set)
+                )
+                img = apply_transform(img, transform)
+            accumulator.add(img)
+        return accumulator.result()
+
+    def transform(self, image_set: ImageSet):
+        return self.blend([image_set])
+
+
 def create_video_from_images(files: List[Path], out_file: Path):
     # with tempfile.TemporaryDirectory() as tmp_dir:
     #     list_file = Path(tmp_dir) / 'files.txt'
@@ -96,54 +188,101 @@ def create_hdr(src_files: List[Path], out_file: Path, method: str = "drago"):
     assert out_file.is_file()
 
 
-def compute_local_time(utc: datetime.datetime):
-    # Get local time
-    # See https://stackoverflow.com/questions/4770297/convert-utc-datetime-string-to-local-datetime
-    from_zone = tz.gettz("UTC")
-    to_zone = tz.gettz("Asia/Jerusalem")
-
-    # Tell the datetime object that it's in UTC time zone since
-    # datetime objects are 'naive' by default
-    utc = utc.replace(tzinfo=from_zone)
+def tonemap_hdr_file(hdr_file: Path, out_file: Path, method: str = "drago"):
+    cmd = f"luminance-hdr-cli -l {hdr_file} --tmo {method} -o {out_file}"
+    run_command(cmd, print_output=False)
+    assert out_file.is_file()
 
-    # Convert time zone
-    local_time = utc.astimezone(to_zone)
-    return local_time
 
+# Used when no compositor is given, e.g. in dask workers
+_default_overlay: Optional[OverlayCompositor] = None
 
-def print_overlay_text(img, image_set):
-    # Parse datetime from iso format
-    utc = datetime.datetime.strptime(image_set.name, "%Y-%m-%dT%H-%M-%S")
-    local_time = compute_local_time(utc)
 
-    # Print file path on image
-    text = f"{image_set.name}     {local_time}"
-    cv2.putText(img, text, (10, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 3)
-    cv2.putText(img, text, (10, 20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 1)
+def print_overlay_text(
+    img, image_set: ImageSet, overlay: Optional[OverlayCompositor] = None
+):
+    global _default_overlay
+    if overlay is None:
+        if _default_overlay is None:
+            _default_overlay = OverlayCompositor()
+        overlay = _default_overlay
+    overlay.draw(img, image_set.name)
 
 
 def get_processed_file_path(
-    image_set: ImageSet, transformer: ImageSetTransformer, processed_dir: Path
+    image_set: ImageSet,
+    transformer: ImageSetTransformer,
+    processed_dir: Path,
+    stabilizer: Optional["Stabilizer"] = None,
 ):
-    return processed_dir / image_set.name / transformer.name / "img.bmp"
+    if stabilizer is None:
+        fname = "img.bmp"
+    else:
+        fname = f"img_stabilized_{stabilizer.reference_key}.bmp"
+    return processed_dir / image_set.name / transformer.name / fname
+
+
+def get_registration_path(image_set: ImageSet) -> Path:
+    # Register using the center bracket, which is the best exposed image
+    return image_set.center_file().src_path
 
 
 def process_single_set(
     image_set: ImageSet,
-    tranformer: ImageSetTransformer,
+    transformer: ImageSetTransformer,
     processed_dir: Path,
     overwrite: bool = False,
+    stabilizer: Optional["Stabilizer"] = None,
+    overlay: Optional[OverlayCompositor] = None,
 ):
 
     logging.info(f"Processing {image_set.name} with transformer {transformer.name}")
 
-    out_file_path = get_processed_file_path(image_set, transformer, processed_dir)
+    out_file_path = get_processed_file_path(
+        image_set, transformer, processed_dir, stabilizer
+    )
     if not overwrite and out_file_path.exists():
         print(f"{image_set.name} already processed. skipping it")
         return
 
-    img = tranformer.transform(image_set)
-    print_overlay_text(img, image_set)
+    img = transformer.transform(image_set)
+    if stabilizer is not None:
+        from post_processor.stabilization import apply_transform
+
+        transform = stabilizer.get_transform(
+            image_set.name, get_registration_path(image_set)
+        )
+        img = apply_transform(img, transform)
+    print_overlay_text(img, image_set, overlay)
+
+    out_file_path.parent.mkdir(parents=True, exist_ok=True)
+    cv2.imwrite(str(out_file_path), img)
+    logging.info(f"Created: {str(out_file_path)}")
+    return None
+
+
+def process_window(
+    window: List[ImageSet],
+    transformer: TemporalBlendTransformer,
+    processed_dir: Path,
+    overwrite: bool = False,
+    overlay: Optional[OverlayCompositor] = None,
+):
+    # Blend a window of image sets into one frame. It is named after the first set.
+    first_set = window[0]
+    logging.info(
+        f"Blending {len(window)} image sets from {first_set.name} with transformer {transformer.name}"
+    )
+
+    out_file_path = get_processed_file_path(
+        first_set, transformer, processed_dir, transformer.stabilizer
+    )
+    if not overwrite and out_file_path.exists():
+        print(f"{first_set.name} already blended. skipping it")
+        return
+
+    img = transformer.blend(window)
+    print_overlay_text(img, first_set, overlay)
 
     out_file_path.parent.mkdir(parents=True, exist_ok=True)
     cv2.imwrite(str(out_file_path), img)
@@ -159,7 +298,9 @@ def read_image_sets_catalog(src_dir: Path, max_sets: Optional[int] = None):
 
     # The directory format is images / day / image_set_name / im*.jpg
     # Walk all the directories at depth 2 (day / image_set_name )
-    the_dirs = list(src_dir.glob("*/*"))
+    the_dirs = sorted(src_dir.glob("*/*"))
+    if max_sets is not None:
+        the_dirs = the_dirs[:max_sets]
 
     def _read(img_set_dir: Path):
         series = img_set_dir.name
@@ -174,20 +315,83 @@ def read_image_sets_catalog(src_dir: Path, max_sets: Optional[int] = None):
             shutter = int(m.group("shutter"))
             image_file = ImageFile(src_path=img, shutter=shutter)
             image_files.append(image_file)
+        image_files.sort(key=lambda x: x.shutter)
         image_series = ImageSet(name=series, files=image_files)
         return image_series
 
-    client = dd.Client(processes=False)
-    image_sets = list(client.gather(client.map(_read, the_dirs)))
+    # Listing directories is I/O bound. A thread pool is enough; starting a
+    # dask cluster here costs more than the listing itself.
+    with ThreadPoolExecutor() as executor:
+        image_sets = list(executor.map(_read, the_dirs))
     image_sets.sort(key=lambda x: x.name)
     return image_sets
 
 
 if __name__ == "__main__":
+    import pandas as pd
+
+    transformers = [
+        HdrTransformer("drago"),
+        HdrTransformer("fattal"),
+        TakeCenterBracketImage(),
+    ]
+    raw_transformers = [RawHdrTransformer("drago")]
+
     args = argparse.ArgumentParser()
     args.add_argument(
         "--download", default=True, help="Download new images from storage"
     )
+    args.add_argument(
+        "--stabilize",
+        action="store_true",
+        help="Register frames against a reference frame and remove camera drift",
+    )
+    args.add_argument(
+        "--stabilize-reference",
+        default=None,
+        help="Image set name of the stabilization reference. Default: the first selected set",
+    )
+    args.add_argument(
+        "--blend",
+        choices=["mean", "median"],
+        default=None,
+        help="Blend all image sets of each day's window into one frame",
+    )
+    args.add_argument(
+        "--blend-start-hour",
+        type=float,
+        default=12,
+        help="Start of the daily blend window, in local hours",
+    )
+    args.add_argument(
+        "--blend-end-hour",
+        type=float,
+        default=13,
+        help="End of the daily blend window, in local hours. Use 0 and 24 for a whole day",
+    )
+    args.add_argument(
+        "--blend-source",
+        choices=[x.name for x in transformers + raw_transformers],
+        default="center_bracket",
+        help="Name of the transformer that produces each frame of the blend",
+    )
+    args.add_argument(
+        "--raw-hdr",
+        action="store_true",
+        help="Also merge HDR from the RAW Bayer data. Needs images captured with RAW",
+    )
+    args.add_argument(
+        "--time-zone",
+        default=config.LOCAL_TIME_ZONE,
+        help="Local time zone for selecting images and for the overlay",
+    )
+    args.add_argument(
+        "--overlay",
+        nargs="*",
+        choices=OVERLAY_ELEMENTS,
+        default=["timestamp"],
+        help="Elements to draw on each frame",
+    )
     args = args.parse_args()
 
     # Log to console
@@ -195,11 +399,8 @@ if __name__ == "__main__":
 
     post_processing_path = Path(config.POST_PROCESSING_PATH)
     if args.download:
-        sync_files(
-            settings.CONTAINER_NAME,
-            date_prefix="",
-            dst_dir=post_processing_path,
-            overwrite=False,
+        download_images(
+            settings.CONTAINER_NAME, date_prefix="", dst_dir=post_processing_path
         )
 
     # Process the pipeline for each image set
@@ -208,30 +409,21 @@ if __name__ == "__main__":
 
     image_sets0 = read_image_sets_catalog(src_dir, max_sets=None)
 
-    # Remove non-full image sets
+    # Remove image sets without the base exposure. The recorder may shoot
+    # fewer brackets (see config.BRACKET_POLICY), but always the base exposure.
     image_sets1 = [
         aset
         for aset in image_sets0
-        if len(aset.files) == len(config.SHUTTER_SPEED_PERCENTS)
+        if any(x.shutter == config.BASE_SHUTTER_SPEED_PERCENT for x in aset.files)
     ]
 
     # For each day, first image set after midday
-    times = []
-    for image_set in image_sets1:
-        utc = datetime.datetime.strptime(image_set.name, "%Y-%m-%dT%H-%M-%S")
-        local_time = compute_local_time(utc)
-        times.append(pd.to_datetime(local_time))
-
+    times = compute_local_times([x.name for x in image_sets1], args.time_zone)
     df = pd.DataFrame({"time": times, "image_set": image_sets1})
-    df.loc[:, "t_since_midday"] = [
-        (
-            t.replace(tzinfo=None) - datetime.datetime(t.year, t.month, t.day, 12, 0)
-        ).total_seconds()
-        / 60
-        / 60
-        for t in times
-    ]
-    df.loc[:, "date"] = [t.date() for t in times]
+    df.loc[:, "t_since_midday"] = (
+        times.hour + times.minute / 60 + times.second / 60 / 60 - 12
+    )
+    df.loc[:, "date"] = times.date
 
     image_sets = []
     for d, grp in df.groupby("date"):
@@ -242,21 +434,90 @@ if __name__ == "__main__":
         image_sets.append(a.iloc[0].image_set)
     image_sets.sort(key=lambda x: x.name)
 
-    transformers = [
-        HdrTransformer("drago"),
-        HdrTransformer("fattal"),
-        TakeCenterBracketImage(),
-    ]
+    # For each day, all image sets in the blend window
+    windows = []
+    if args.blend:
+        df.loc[:, "local_hour"] = df.t_since_midday + 12
+        for d, grp in df.groupby("date"):
+            a = grp[
+                (grp.local_hour >= args.blend_start_hour)
+                & (grp.local_hour < args.blend_end_hour)
+            ]
+            if len(a) == 0:
+                continue
+            windows.append(sorted(a.image_set, key=lambda x: x.name))
+        windows.sort(key=lambda x: x[0].name)
+        image_sets = [window[0] for window in windows]
+
+    if args.raw_hdr:
+        transformers += raw_transformers
 
     # List files, group by series
     processed_dir.mkdir(exist_ok=True)
 
-    client = dd.Client()  # (processes=False)
+    overlay = OverlayCompositor(args.overlay, tz_name=args.time_zone)
+    overlay.prepare([x.name for x in image_sets])
+
+    # Estimate the drift of each frame once. Transforms are cached on disk.
+    stabilizer = None
+    if args.stabilize:
+        reference_name = args.stabilize_reference or image_sets[0].name
+        reference_sets = [x for x in image_sets1 if x.name == reference_name]
+        if len(reference_sets) == 0:
+            raise Exception(
+                f"Stabilization reference {reference_name} not found among the image sets in {src_dir}"
+            )
+        reference_set = reference_sets[0]
+        from post_processor.stabilization import Stabilizer
+
+        stabilizer = Stabilizer(
+            reference_path=get_registration_path(reference_set),
+            cache_path=processed_dir / "stabilization.json",
+        )
+        sets_to_register = [x for w in windows for x in w] if args.blend else image_sets
+        stabilizer.compute_all(
+            [(x.name, get_registration_path(x)) for x in sets_to_register]
+        )
+
+    if args.blend:
+        frame_transformer = next(
+            x for x in transformers + raw_transformers if x.name == args.blend_source
+        )
+        transformers = [
+            TemporalBlendTransformer(
+                frame_transformer,
+                args.blend,
+                args.blend_start_hour,
+                args.blend_end_hour,
+                stabilizer,
+            )
+        ]
+
     for transformer in transformers:
-        if False:
+        if args.blend:
+            # Days are independent. Each worker holds one accumulator at a time.
+            import dask.distributed as dd
+
+            client = dd.Client()
+            futures = client.map(
+                lambda window: process_window(
+                    window, transformer, processed_dir, overwrite=False, overlay=overlay
+                ),
+                windows,
+            )
+            client.gather(futures)
+        elif False:
+            import dask.distributed as dd
+
+            client = dd.Client()  # (processes=False)
             futures = client.map(
                 lambda image_set: process_single_set(
-                    image_set, transformer, processed_dir, overwrite=True
+                    image_set,
+                    transformer,
+                    processed_dir,
+                    overwrite=True,
+                    stabilizer=stabilizer,
+                    overlay=overlay,
                 ),
                 image_sets,
             )
@@ -264,22 +525,32 @@ if __name__ == "__main__":
         else:
             for image_set in image_sets:
                 process_single_set(
-                    image_set, transformer, processed_dir, overwrite=False
+                    image_set,
+                    transformer,
+                    processed_dir,
+                    overwrite=False,
+                    stabilizer=stabilizer,
+                    overlay=overlay,
                 )
         for image_set in image_sets:
-            afile = get_processed_file_path(image_set, transformer, processed_dir)
+            afile = get_processed_file_path(
+                image_set, transformer, processed_dir, stabilizer
+            )
             assert afile.exists()
 
     # Create a video per each transformer
     for transformer in transformers:
         files_for_video = []
         for image_set in image_sets:
-            afile = get_processed_file_path(image_set, transformer, processed_dir)
+            afile = get_processed_file_path(
+                image_set, transformer, processed_dir, stabilizer
+            )
             assert afile.exists()
             files_for_video.append(afile)
 
         # Create video from list of files using ffmpeg
-        video_path = processed_dir / f"{transformer.name}.mp4"
+        suffix = "_stabilized" if args.stabilize else ""
+        video_path = processed_dir / f"{transformer.name}{suffix}.mp4"
         create_video_from_images(files_for_video, video_path)
 
     # post_production_dir = Path("../PostProduction")
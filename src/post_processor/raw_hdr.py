@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+# RAW Bayer extraction and linear HDR merge
+# =========================================
+# `raspistill --raw` (and picamera's capture(..., bayer=True)) append the
+# sensor's 10-bit Bayer data to the JPEG. The block starts with a "BRCM"
+# header of 32768 bytes, followed by rows of packed 10-bit pixels: every 5
+# bytes hold 4 pixels, the 8 high bits of each, then a byte with the 2 low
+# bits of all four. Rows are padded (stride), and so is the row count. The
+# header records the Bayer order, which depends on the sensor and on the
+# flips the capture was taken with.
+# See: https://picamera.readthedocs.io/en/release-1.13/recipes2.html#raw-bayer-data-captures
+#
+# Merging brackets in linear RAW space avoids the gamma and tone curve of the
+# JPEGs. Everything is vectorized NumPy, reading the file through mmap and
+# np.frombuffer so the RAW block is not copied before unpacking.
+import dataclasses
+import mmap
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import common.config as config
+
+RAW_HEADER_SIZE = 32768
+RAW_MAGIC = b"BRCM"
+RAW_MAX_VALUE = 1023
+
+# Offset of the Bayer order byte in the header: the sensor header starts at
+# byte 176 and its bayer_order field at byte 68 of it (after the name, size,
+# padding and transform fields). See picamera's BroadcomRawHeader.
+RAW_BAYER_ORDER_OFFSET = 176 + 68
+# Bayer order codes, as the color of the 2x2 cell in data order
+RAW_BAYER_ORDERS = {0: "RGGB", 1: "GBRG", 2: "BGGR", 3: "GRBG"}
+
+
+@dataclass
+class RawLayout:
+    """Layout of the RAW block of one sensor."""
+
+    width: int
+    height: int
+    # Bytes per row and rows, including padding
+    stride: int
+    rows: int
+    # Sensor black level, in 10-bit counts
+    black_level: int
+    # Color of the 2x2 Bayer cell, in data order (row 0 then row 1). Read from
+    # the header of each file.
+    bayer_pattern: Optional[str] = None
+
+    @property
+    def block_size(self):
+        return RAW_HEADER_SIZE + self.stride * self.rows
+
+
+# Keyed by RAW block size, which identifies the sensor
+RAW_LAYOUTS = {
+    layout.block_size: layout
+    for layout in [
+        # Camera module v1 (OV5647)
+        RawLayout(width=2592, height=1944, stride=3264, rows=1952, black_level=16),
+        # Camera module v2 (IMX219)
+        RawLayout(width=3280, height=2464, stride=4128, rows=2480, black_level=64),
+    ]
+}
+
+
+def find_raw_layout(data) -> RawLayout:
+    # The RAW block is at the end of the file. Its size identifies the sensor.
+    for size, layout in RAW_LAYOUTS.items():
+        start = len(data) - size
+        if len(data) >= size and data[start : start + 4] == RAW_MAGIC:
+            order = data[start + RAW_BAYER_ORDER_OFFSET]
+            if order not in RAW_BAYER_ORDERS:
+                raise Exception(f"Unknown Bayer order in RAW header: {order}")
+            return dataclasses.replace(layout, bayer_pattern=RAW_BAYER_ORDERS[order])
+    raise Exception("No RAW Bayer block found. Was the image captured with --raw?")
+
+
+def unpack_raw10(packed: np.ndarray, width: int) -> np.ndarray:
+    """Unpack rows of packed 10-bit pixels (uint8, shape rows x bytes) to uint16."""
+    groups = packed[:, : width * 5 // 4].reshape(packed.shape[0], width // 4, 5)
+    pixels = groups[:, :, :4].astype(np.uint16) << 2
+    low_bits = groups[:, :, 4:5] >> np.array([0, 2, 4, 6], dtype=np.uint8)
+    pixels |= low_bits & 0b11
+    return pixels.reshape(packed.shape[0], width)
+
+
+def pack_raw10(pixels: np.ndarray, stride: int) -> np.ndarray:
+    # Inverse of unpack_raw10, with row padding. Used to create synthetic RAW files.
+    h, w = pixels.shape
+    groups = pixels.reshape(h, w // 4, 4).astype(np.uint16)
+    packed = np.zeros((h, w // 4, 5), dtype=np.uint8)
+    packed[:, :, :4] = groups >> 2
+    low_bits = (groups & 0b11) << np.array([0, 2, 4, 6], dtype=np.uint16)
+    packed[:, :, 4] = low_bits.sum(axis=2)
+    out = np.zeros((h, stride), dtype=np.uint8)
+    out[:, : w * 5 // 4] = packed.reshape(h, -1)
+    return out
+
+
+def read_raw_bayer(path: Path):
+    """Read the RAW Bayer data appended to a JPEG.
+
+    Returns the uint16 Bayer mosaic (height x width) and its RawLayout.
+    """
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        layout = find_raw_layout(mm)
+        offset = len(mm) - layout.block_size + RAW_HEADER_SIZE
+        packed = np.frombuffer(
+            mm, dtype=np.uint8, count=layout.stride * layout.rows, offset=offset
+        ).reshape(layout.rows, layout.stride)
+        bayer = unpack_raw10(packed[: layout.height], layout.width)
+        # Release the buffer export before the mmap is closed
+        del packed
+    return bayer, layout
+
+
+def demosaic_half(bayer: np.ndarray, layout: RawLayout) -> np.ndarray:
+    """Half resolution demosaic. Each 2x2 Bayer cell becomes one pixel.
+
+    Returns linear float32 planes (B, G, R) of shape 3 x h/2 x w/2, in 0..1,
+    black level subtracted. Planar layout keeps the per-pixel math vectorized
+    over contiguous rows.
+    """
+    cells = {
+        layout.bayer_pattern[0]: [bayer[0::2, 0::2]],
+        layout.bayer_pattern[1]: [bayer[0::2, 1::2]],
+    }
+    cells.setdefault(layout.bayer_pattern[2], []).append(bayer[1::2, 0::2])
+    cells.setdefault(layout.bayer_pattern[3], []).append(bayer[1::2, 1::2])
+
+    h, w = bayer.shape
+    out = np.empty((3, h // 2, w // 2), dtype=np.float32)
+    scale = np.float32(1.0 / (RAW_MAX_VALUE - layout.black_level))
+    for i, color in enumerate("BGR"):
+        sites = cells[color]
+        if len(sites) == 2:
+            # Green appears twice in the cell. Average it. Sums fit in uint16.
+            np.add(sites[0], sites[1], out=out[i], dtype=np.float32)
+            out[i] *= 0.5
+        else:
+            out[i] = sites[0]
+    out -= layout.black_level
+    out *= scale
+    np.clip(out, 0, 1, out=out)
+    return out
+
+
+def _hat_weight(z: np.ndarray) -> np.ndarray:
+    # Trust mid-tones most. Near-black pixels are noisy and near-white ones
+    # may be clipped. The brightest channel decides, so colors stay consistent.
+    m = np.maximum(np.maximum(z[0], z[1]), z[2])
+    w = np.subtract(1, m)
+    np.minimum(w, m, out=w)
+    w *= 2
+    w[m > 0.95] = 0
+    return w
+
+
+def merge_linear_hdr(
+    paths: Sequence[Path],
+    exposures: Sequence[float],
+    awb_gains: Optional[Tuple[float, float]] = None,
+    gray_world: bool = False,
+) -> np.ndarray:
+    """Merge bracketed RAW captures into a linear radiance map.
+
+    `exposures` are the relative exposure times (e.g. shutter percent / 100).
+    Frames are decoded one at a time and accumulated in float32. Returns a
+    float32 BGR image at half the sensor resolution.
+
+    RAW data has no white balance applied. It is white balanced with the
+    fixed (red, blue) `awb_gains`, config.RAW_AWB_GAINS by default, so that
+    consecutive frames match. With `gray_world`, the gains are estimated from
+    this image instead, which flickers when used for a timelapse.
+    """
+    numerator = None
+    denominator = None
+    shortest = None
+    for i in np.argsort(exposures):
+        bayer, layout = read_raw_bayer(paths[i])
+        z = demosaic_half(bayer, layout)
+        del bayer
+        w = _hat_weight(z)
+
+        # Radiance is z / exposure. Accumulate its weighted sum in place.
+        z *= np.float32(1.0 / exposures[i])
+        if shortest is None:
+            # Pixels clipped in every frame take the shortest exposure's value
+            shortest = z.copy()
+            numerator = np.zeros_like(z)
+            denominator = np.zeros_like(w)
+        z *= w
+        numerator += z
+        denominator += w
+
+    valid = denominator > 0
+    np.divide(numerator, denominator, out=shortest, where=valid)
+    hdr = shortest
+
+    if gray_world:
+        means = hdr.reshape(3, -1).mean(axis=1)
+        blue_gain, _, red_gain = means[1] / np.maximum(means, 1e-6)
+    else:
+        red_gain, blue_gain = config.RAW_AWB_GAINS if awb_gains is None else awb_gains
+    hdr[0] *= np.float32(blue_gain)
+    hdr[2] *= np.float32(red_gain)
+
+    # Interleave to BGR, like images read with cv2
+    return np.ascontiguousarray(hdr.transpose(1, 2, 0))
+
+
+def merge_image_set(files: List) -> np.ndarray:
+    # Merge the RAW data of a list of ImageFile (post_processing.py)
+    return merge_linear_hdr(
+        [x.src_path for x in files], [x.shutter / 100.0 for x in files]
+    )
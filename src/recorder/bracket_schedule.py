@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+# Bracket scheduling
+# ==================
+# Decide which exposures to shoot for each image series. Shooting the full
+# bracket every interval wastes capture time, storage and upload bytes at
+# night, on flat overcast days, and at times of day the post-processor never
+# uses.
+#
+# Policies:
+#   full      - Always shoot config.SHUTTER_SPEED_PERCENTS (the original behavior).
+#   adaptive  - Meter a small frame at the base exposure. Add shorter exposures
+#               only if highlights clip, and longer ones only if shadows clip.
+#   keyframe  - Shoot brackets (with the adaptive policy) only inside
+#               config.KEYFRAME_WINDOWS, and a single base exposure outside.
+# Every plan includes the base exposure (config.BASE_SHUTTER_SPEED_PERCENT),
+# so every series has a frame comparable with all others.
+from datetime import datetime, timezone
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import src.common.config as config
+from common.utils import get_time_zone
+
+# Luma levels considered clipped, and the fractions of clipped pixels that
+# call for one or two extra exposures on that side.
+SHADOW_LEVEL = 16
+HIGHLIGHT_LEVEL = 240
+CLIP_FRACTIONS = [0.01, 0.05]
+
+# Mean luma below which the scene is considered night. The sensor is at its
+# limit and bracketing adds nothing.
+NIGHT_MEAN_LEVEL = 20
+
+Meter = Callable[[], np.ndarray]
+
+
+class BracketPolicy:
+    def plan(self, utc_time: datetime, meter: Meter) -> List[int]:
+        """Return the shutter speed percents to capture, in ascending order.
+
+        `utc_time` is the (naive) UTC time of the series. `meter` returns the luma of a low resolution frame at the base exposure.
+        Policies call it only if they need it.
+        """
+        raise Exception("Not implemented")
+
+
+class FullBracketPolicy(BracketPolicy):
+    def __init__(self, shutter_speed_percents: Optional[Sequence[int]] = None):
+        if shutter_speed_percents is None:
+            shutter_speed_percents = config.SHUTTER_SPEED_PERCENTS
+        self.shutter_speed_percents = sorted(shutter_speed_percents)
+
+    def plan(self, utc_time, meter):
+        return list(self.shutter_speed_percents)
+
+
+class AdaptiveBracketPolicy(BracketPolicy):
+    def __init__(self, shutter_speed_percents: Optional[Sequence[int]] = None):
+        if shutter_speed_percents is None:
+            shutter_speed_percents = config.SHUTTER_SPEED_PERCENTS
+        base = config.BASE_SHUTTER_SPEED_PERCENT
+        # Nearest to the base exposure first
+        self.shorter = sorted([p for p in shutter_speed_percents if p < base])[::-1]
+        self.longer = sorted([p for p in shutter_speed_percents if p > base])
+
+    def plan(self, utc_time, meter):
+        luma = meter()
+        hist = np.bincount(luma.ravel(), minlength=256) / luma.size
+        if np.dot(hist, np.arange(len(hist))) < NIGHT_MEAN_LEVEL:
+            return [config.BASE_SHUTTER_SPEED_PERCENT]
+
+        shadows = hist[:SHADOW_LEVEL].sum()
+        highlights = hist[HIGHLIGHT_LEVEL:].sum()
+        n_shorter = sum(highlights > x for x in CLIP_FRACTIONS)
+        n_longer = sum(shadows > x for x in CLIP_FRACTIONS)
+
+        # The most severe clipping uses all the remaining exposures on that side
+        if n_shorter == len(CLIP_FRACTIONS):
+            n_shorter = len(self.shorter)
+        if n_longer == len(CLIP_FRACTIONS):
+            n_longer = len(self.longer)
+
+        percents = (
+            self.shorter[:n_shorter]
+            + [config.BASE_SHUTTER_SPEED_PERCENT]
+            + self.longer[:n_longer]
+        )
+        return sorted(percents)
+
+
+class KeyframeWindowPolicy(BracketPolicy):
+    def __init__(
+        self,
+        inner: BracketPolicy,
+        windows: Optional[Sequence[Tuple[float, float]]] = None,
+    ):
+        self.inner = inner
+        self.windows = config.KEYFRAME_WINDOWS if windows is None else windows
+
+    def in_window(self, utc_time: datetime) -> bool:
+        local_time = to_local_time(utc_time)
+        hour = local_time.hour + local_time.minute / 60 + local_time.second / 3600
+        return any(start <= hour < end for start, end in self.windows)
+
+    def plan(self, utc_time, meter):
+        if self.in_window(utc_time):
+            return self.inner.plan(utc_time, meter)
+        return [config.BASE_SHUTTER_SPEED_PERCENT]
+
+
+def create_bracket_policy(name: str) -> BracketPolicy:
+    if name == "full":
+        return FullBracketPolicy()
+    if name == "adaptive":
+        return AdaptiveBracketPolicy()
+    if name == "keyframe":
+        return KeyframeWindowPolicy(AdaptiveBracketPolicy())
+    raise Exception(f"Unknown bracket policy: {name}")
+
+
+def to_local_time(utc: datetime) -> datetime:
+    zone = get_time_zone(config.LOCAL_TIME_ZONE)
+    return utc.replace(tzinfo=timezone.utc).astimezone(zone)
@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+# Camera backends
+# ===============
+# The recorder talks to the camera through this small interface, so that the
+# capture loop and the bracket scheduling can run with a fake camera.
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+import src.common.config as config
+from common.utils import DEFAULT_FRAME_WH
+
+# Size of the low resolution frame used for metering
+METERING_WH = (128, 96)
+
+
+class PiCameraBackend:
+    """Captures with picamera, with fixed exposure and white balance."""
+
+    def __init__(self, agc_settle_sec: float = 5, shutter_settle_sec: float = 1):
+        self.agc_settle_sec = agc_settle_sec
+        self.shutter_settle_sec = shutter_settle_sec
+        self.camera = None
+        self.base_speed = None
+
+    def __enter__(self):
+        from picamera.camera import PiCamera
+
+        self.camera = PiCamera(resolution=DEFAULT_FRAME_WH, framerate=2)
+        self.camera.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self.camera.__exit__(*exc)
+
+    def lock_exposure(self):
+        camera = self.camera
+
+        # Set ISO
+        camera.iso = config.CAMERA_ISO
+
+        # Wait for the automatic gain control to settle
+        time.sleep(self.agc_settle_sec)
+
+        # Now fix the values
+        self.base_speed = camera.exposure_speed
+        camera.shutter_speed = camera.exposure_speed
+        camera.exposure_mode = "off"
+        awb_gains = camera.awb_gains
+        camera.awb_mode = "off"
+        camera.awb_gains = awb_gains
+
+    def meter(self) -> np.ndarray:
+        # Return the luma of a small frame taken at the base exposure
+        from picamera.array import PiYUVArray
+
+        with PiYUVArray(self.camera, size=METERING_WH) as stream:
+            self.camera.capture(
+                stream, format="yuv", resize=METERING_WH, use_video_port=True
+            )
+            return stream.array[:, :, 0]
+
+    def capture(self, out_fname: Path, shutter_speed_percent: int):
+        camera = self.camera
+        desired_speed = round(shutter_speed_percent / 100.0 * self.base_speed)
+        if camera.shutter_speed != desired_speed:
+            camera.shutter_speed = desired_speed
+
+            # Need to wait for the command to take effect
+            time.sleep(self.shutter_settle_sec)
+
+        # With bayer=True the RAW sensor data is appended to the JPEG
+        camera.capture(str(out_fname), bayer=config.CAPTURE_RAW)
+        return {
+            "camera.framerate": repr(camera.framerate),
+            "desired_speed": desired_speed / 1000,
+            "camera.exposure_speed": camera.exposure_speed / 1000,
+            "camera.awb_gains": [float(x) for x in camera.awb_gains],
+        }
+
+
+class FakeCameraBackend:
+    """A camera that returns a given metering frame and writes placeholder files.
+
+    Captures are recorded in `captures` as (path, shutter_speed_percent).
+    """
+
+    def __init__(self, luma: Optional[np.ndarray] = None):
+        if luma is None:
+            luma = np.full(METERING_WH[::-1], 128, dtype=np.uint8)
+        self.luma = luma
+        self.metered = 0
+        self.captures: List[Tuple[Path, int]] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def lock_exposure(self):
+        pass
+
+    def meter(self) -> np.ndarray:
+        self.metered += 1
+        return self.luma
+
+    def capture(self, out_fname: Path, shutter_speed_percent: int):
+        Path(out_fname).write_bytes(b"fake")
+        self.captures.append((Path(out_fname), shutter_speed_percent))
+        return {}
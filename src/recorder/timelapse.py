@@ -4,16 +4,14 @@ from datetime import datetime
 from pathlib import Path
 import time
 from typing import Optional
-from dotenv import load_dotenv
 import argparse
 import logging
-from opencensus.ext.azure.log_exporter import AzureLogHandler
-from picamera.camera import PiCamera
-from common.storage import upload_to_remote_storage
-from common.utils import capture_still, DEFAULT_FRAME_WH
-import json
+from common.storage import get_manifest_prefix, upload_to_remote_storage
 import src.common.config as config
 
+# Heavy dependencies (picamera, opencensus, numpy) are imported inside the
+# functions that use them, so that e.g. --view starts without loading them.
+
 
 def get_image_out_path(dst_dir, series_datetime: datetime, shutter_speed_percent: int):
     # Return image file and directory.
@@ -33,48 +31,42 @@ def get_image_out_path(dst_dir, series_datetime: datetime, shutter_speed_percent
     return out_file, datetime_str
 
 
-def capture_picamera_method(dst_dir: Path):
+def capture_picamera_method(dst_dir: Path, policy=None, camera_backend=None):
+    # policy is a recorder.bracket_schedule.BracketPolicy, camera_backend a
+    # class from recorder.camera. Defaults come from config and the Pi camera.
+    from recorder.bracket_schedule import create_bracket_policy
+    from recorder.camera import PiCameraBackend
+
+    if policy is None:
+        policy = create_bracket_policy(config.BRACKET_POLICY)
+    if camera_backend is None:
+        camera_backend = PiCameraBackend
 
     # Get time, which we'll use to name the output images series
     series_datetime = datetime.utcnow().replace(microsecond=0)
 
-    with PiCamera(resolution=DEFAULT_FRAME_WH, framerate=2) as camera:
-        # Set ISO
-        camera.iso = config.CAMERA_ISO
-
-        # Wait for the automatic gain control to settle
-        time.sleep(5)
+    with camera_backend() as camera:
+        camera.lock_exposure()
 
-        # Now fix the values
-        base_speed = camera.exposure_speed
-        camera.shutter_speed = camera.exposure_speed
-        camera.exposure_mode = "off"
-        awb_gains = camera.awb_gains
-        camera.awb_mode = "off"
-        camera.awb_gains = awb_gains
+        # Decide which exposures to take
+        shutter_speed_percents = policy.plan(series_datetime, camera.meter)
 
-        # Finally, take several photos with the fixed settings
-        for i, shutter_speed_percent in enumerate(config.SHUTTER_SPEED_PERCENTS):
-            desired_speed = round(shutter_speed_percent / 100.0 * base_speed)
-            camera.shutter_speed = desired_speed
-
-            # Need to wait for the command to take effect
-            time.sleep(1)
+        # Finally, take the photos with the fixed settings
+        for i, shutter_speed_percent in enumerate(shutter_speed_percents):
             out_fname, image_series_name = get_image_out_path(
                 dst_dir, series_datetime, shutter_speed_percent
             )
             out_fname.parent.mkdir(parents=True, exist_ok=True)
 
-            camera.capture(str(out_fname))
+            camera_props = camera.capture(out_fname, shutter_speed_percent)
 
             props = {
                 "series_name": image_series_name,
                 "index": i,
                 "filename": str(out_fname),
                 "shutter_speed_percent": shutter_speed_percent,
-                "camera.framerate": repr(camera.framerate),
-                "desired_speed": desired_speed / 1000,
-                "camera.exposure_speed": camera.exposure_speed / 1000,
+                "bracket_size": len(shutter_speed_percents),
+                **camera_props,
             }
 
             logging.info(f"Capture: {str(props)}", extra={"custom_dimensions": props})
@@ -88,10 +80,14 @@ def upload_files_and_delete(timelapse_name, local_dir):
         source=str(local_dir),
         dest=f"{timelapse_name}/images",
         delete=True,
+        manifest_prefix=get_manifest_prefix(timelapse_name),
     )
 
 
 def main():
+    from dotenv import load_dotenv
+    from opencensus.ext.azure.log_exporter import AzureLogHandler
+
     print("Starting recorder")
     load_dotenv()
 
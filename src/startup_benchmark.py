@@ -0,0 +1,93 @@
+#!/usr/bin/python3
+# Measure the import cost of the entry points.
+# Each module is imported in a fresh interpreter with `python -X importtime`,
+# so the numbers include everything the entry point pulls in at load time.
+#
+# Usage:
+#   python3 startup_benchmark.py                 # print a report
+#   python3 startup_benchmark.py --max-ms 500    # fail if an entry point is slower
+import argparse
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+ENTRY_POINTS = [
+    "recorder.timelapse",
+    "post_processor.post_processing",
+    "common.storage",
+]
+
+SRC_DIR = Path(__file__).resolve().parent
+
+
+def _run_importtime(code: str):
+    # Return the imports logged by `python -X importtime -c code` as
+    # (cumulative ms, name, is top level) tuples
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [str(SRC_DIR), str(SRC_DIR.parent), env.get("PYTHONPATH", "")]
+    )
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        env=env,
+        cwd=str(SRC_DIR),
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        last_line = proc.stderr.strip().splitlines()[-1]
+        raise Exception(f"Failed to run {code}: {last_line}")
+
+    # Lines look like: "import time:   self [us] | cumulative | imported package"
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        # Top-level imports are not indented
+        imports.append(
+            (int(cumulative) / 1000, name.strip(), not name.startswith("  "))
+        )
+    return imports
+
+
+def measure_import(module: str):
+    # Return total import time in ms and the slowest imports as (ms, name) tuples.
+    # Modules that the interpreter imports at startup (site, encodings, ...)
+    # are excluded, so the total is the cost of the entry point only.
+    startup = {name for _, name, _ in _run_importtime("pass")}
+    imports = [x for x in _run_importtime(f"import {module}") if x[1] not in startup]
+    total_ms = sum(ms for ms, _, top_level in imports if top_level)
+    slowest = sorted([(ms, name) for ms, name, _ in imports], reverse=True)
+    return total_ms, slowest
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--max-ms",
+        type=float,
+        default=None,
+        help="Fail if any entry point takes longer than this to import",
+    )
+    parser.add_argument(
+        "--top", type=int, default=5, help="Number of slowest imports to show"
+    )
+    args = parser.parse_args()
+
+    failed = []
+    for module in ENTRY_POINTS:
+        total_ms, imports = measure_import(module)
+        print(f"{module}: {total_ms:.1f} ms")
+        for ms, name in imports[: args.top]:
+            print(f"    {ms:8.1f} ms  {name}")
+        if args.max_ms is not None and total_ms > args.max_ms:
+            failed.append(module)
+
+    if failed:
+        raise SystemExit(f"Import time above {args.max_ms} ms: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+# Modules are imported both as `common.config` (run from src/) and as
+# `src.common.config`, so both directories go on the path.
+ROOT_DIR = Path(__file__).resolve().parents[1]
+sys.path[:0] = [str(ROOT_DIR / "src"), str(ROOT_DIR)]
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from post_processor.blending import RunningMean, RunningMedian, create_accumulator
+
+SHAPE = (24, 32, 3)
+
+
+def _window(levels):
+    rng = np.random.default_rng(0)
+    noise = rng.integers(-3, 4, (len(levels), *SHAPE))
+    return np.clip(np.array(levels)[:, None, None, None] + noise, 0, 255).astype(
+        np.uint8
+    )
+
+
+def _blend(accumulator, frames):
+    for frame in frames:
+        accumulator.add(frame)
+    return accumulator.result()
+
+
+WINDOWS = {
+    # 60 frames (12-13h at 60 s) with a transient in the first 5
+    "transient_first_frames": [250] * 5 + [50] * 55,
+    # 10 frames with a transient in the first one only
+    "transient_first_frame": [250] + [50] * 9,
+    # A passing cloud in the middle of the window
+    "transient_middle": [50] * 20 + [200] * 10 + [50] * 30,
+    # Brightness ramp over a whole day
+    "ramp": list(np.linspace(0, 255, 60)),
+    "even_count": [10, 20, 30, 40],
+}
+
+
+@pytest.mark.parametrize("levels", WINDOWS.values(), ids=WINDOWS.keys())
+def test_median_is_exact(levels):
+    frames = _window(levels)
+    # A small tile budget, so the median is computed over several bands of rows
+    median = _blend(RunningMedian(max_tile_bytes=20000), frames)
+    assert median.dtype == np.uint8
+    expected = np.round(np.median(frames, axis=0)).astype(np.uint8)
+    np.testing.assert_array_equal(median, expected)
+
+
+def test_median_of_float_frames():
+    frames = np.random.default_rng(1).random((7, *SHAPE)).astype(np.float32)
+    median = _blend(RunningMedian(), frames)
+    assert median.dtype == np.float32
+    np.testing.assert_allclose(median, np.median(frames, axis=0), rtol=1e-6)
+
+
+@pytest.mark.parametrize("levels", WINDOWS.values(), ids=WINDOWS.keys())
+def test_mean(levels):
+    frames = _window(levels)
+    mean = _blend(RunningMean(), frames)
+    assert mean.dtype == np.uint8
+    expected = np.round(frames.mean(axis=0, dtype=np.float64)).astype(np.uint8)
+    np.testing.assert_array_equal(mean, expected)
+
+
+def test_create_accumulator():
+    assert isinstance(create_accumulator("median"), RunningMedian)
+    with pytest.raises(Exception, match="Unknown blend method"):
+        create_accumulator("max")
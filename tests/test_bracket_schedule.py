@@ -0,0 +1,84 @@
+from datetime import datetime
+
+import numpy as np
+
+from recorder.bracket_schedule import (
+    AdaptiveBracketPolicy,
+    FullBracketPolicy,
+    KeyframeWindowPolicy,
+)
+from recorder.camera import METERING_WH, FakeCameraBackend
+from recorder.timelapse import capture_picamera_method
+
+PERCENTS = [20, 50, 100, 200, 500]
+# Series times are UTC. 12:30 in Jerusalem (config.LOCAL_TIME_ZONE).
+NOON = datetime(2022, 6, 15, 9, 30)
+
+
+def _luma(levels_and_fractions):
+    # A metering frame with the given fractions of pixels at each level
+    h, w = METERING_WH[::-1]
+    values = []
+    for level, fraction in levels_and_fractions:
+        values += [level] * int(round(fraction * h * w))
+    return np.array(values, dtype=np.uint8).reshape(h, w)
+
+
+def _plan(policy, luma, utc_time=NOON):
+    camera = FakeCameraBackend(luma)
+    return policy.plan(utc_time, camera.meter), camera.metered
+
+
+def test_flat_scene_takes_base_exposure_only():
+    luma = _luma([(128, 1.0)])
+    assert _plan(AdaptiveBracketPolicy(PERCENTS), luma) == ([100], 1)
+
+
+def test_night_takes_base_exposure_only():
+    # Mostly black, with a few clipped lights
+    luma = _luma([(2, 0.98), (255, 0.02)])
+    assert _plan(AdaptiveBracketPolicy(PERCENTS), luma) == ([100], 1)
+
+
+def test_clipped_highlights_add_shorter_exposures():
+    luma = _luma([(128, 0.97), (255, 0.03)])
+    assert _plan(AdaptiveBracketPolicy(PERCENTS), luma) == ([50, 100], 1)
+
+    luma = _luma([(128, 0.9), (255, 0.1)])
+    assert _plan(AdaptiveBracketPolicy(PERCENTS), luma) == ([20, 50, 100], 1)
+
+
+def test_clipped_shadows_and_highlights_take_full_bracket():
+    luma = _luma([(0, 0.1), (128, 0.8), (255, 0.1)])
+    assert _plan(AdaptiveBracketPolicy(PERCENTS), luma) == (PERCENTS, 1)
+
+
+def test_full_policy_does_not_meter():
+    assert _plan(FullBracketPolicy(PERCENTS[::-1]), None) == (PERCENTS, 0)
+
+
+def test_keyframe_policy_brackets_only_inside_windows():
+    policy = KeyframeWindowPolicy(FullBracketPolicy(PERCENTS), windows=[(11.5, 13.5)])
+    assert _plan(policy, None, NOON) == (PERCENTS, 0)
+    assert _plan(policy, None, datetime(2022, 6, 15, 6, 0)) == ([100], 0)
+
+
+def test_capture_with_fake_camera(tmp_path):
+    camera = FakeCameraBackend(_luma([(128, 0.9), (255, 0.1)]))
+    series = capture_picamera_method(
+        tmp_path, policy=AdaptiveBracketPolicy(PERCENTS), camera_backend=lambda: camera
+    )
+    assert camera.metered == 1
+    assert [shutter for _, shutter in camera.captures] == [20, 50, 100]
+
+    day = series.split("T")[0]
+    written = sorted(
+        p.relative_to(tmp_path).as_posix() for p in tmp_path.rglob("*.jpg")
+    )
+    assert written == [
+        f"{day}/{series}/{series}--shutter_{shutter:03d}.jpg"
+        for shutter in [20, 50, 100]
+    ]
+    assert written == sorted(
+        p.relative_to(tmp_path).as_posix() for p, _ in camera.captures
+    )
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from post_processor.overlay import (
+    OverlayCompositor,
+    YearProgressBar,
+    compute_local_times,
+    compute_sun_elevation,
+)
+
+
+def test_compute_local_times():
+    times = compute_local_times(["2022-06-21T09-30-00"], "Asia/Jerusalem")
+    assert str(times[0]) == "2022-06-21 12:30:00+03:00"
+
+
+def test_sun_elevation_at_solar_noon():
+    # Jerusalem on the June solstice: 90 - 31.77 + 23.44 = 81.7 degrees
+    day = pd.date_range("2022-06-21 00:00", periods=24 * 60, freq="min", tz="UTC")
+    elevations = compute_sun_elevation(day, latitude=31.77, longitude=35.21)
+    assert elevations.max() == pytest.approx(81.7, abs=0.2)
+    # Local solar noon is ~9:40 UTC
+    noon = day[np.argmax(elevations)]
+    assert (noon.hour, noon.minute // 10) == (9, 4)
+    assert elevations.min() < -30
+
+
+def test_year_progress_values():
+    names = ["2022-01-01T00-00-00", "2022-07-02T12-00-00", "2024-12-31T12-00-00"]
+    local_times = compute_local_times(names, "UTC")
+    fractions = YearProgressBar().values(names, local_times)
+    np.testing.assert_allclose(fractions, [0, 0.5, 365.5 / 366])
+
+
+def test_draw_unprepared_name():
+    overlay = OverlayCompositor(
+        ["timestamp", "year_progress", "sun_elevation"], tz_name="Asia/Jerusalem"
+    )
+    overlay.prepare(["2022-06-21T09-30-00"])
+    prepared = dict(overlay._prepared)
+
+    img = np.full((120, 480, 3), 128, dtype=np.uint8)
+    overlay.draw(img, "2022-06-22T09-30-00")
+    assert overlay._prepared == prepared
+    assert "2022-06-22T09-30-00" in overlay._unprepared
+    # White text and black outline were drawn
+    assert (img[5:25, 10:400] == 255).any() and (img[5:25, 10:400] == 0).any()
+
+
+def test_draw_on_float_frame():
+    overlay = OverlayCompositor(tz_name="UTC")
+    img = np.zeros((40, 480, 3), dtype=np.float32)
+    overlay.draw(img, "2022-06-21T09-30-00")
+    assert img.max() == pytest.approx(255, abs=1)
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+from post_processor.raw_hdr import (
+    RAW_BAYER_ORDER_OFFSET,
+    RAW_HEADER_SIZE,
+    RAW_LAYOUTS,
+    RAW_MAGIC,
+    RAW_MAX_VALUE,
+    merge_linear_hdr,
+    pack_raw10,
+    read_raw_bayer,
+)
+
+# Camera module v1 (OV5647) and v2 (IMX219)
+V1 = next(x for x in RAW_LAYOUTS.values() if x.width == 2592)
+V2 = next(x for x in RAW_LAYOUTS.values() if x.width == 3280)
+LAYOUTS = pytest.mark.parametrize("layout", [V1, V2], ids=["v1", "v2"])
+
+
+def test_black_levels():
+    assert (V1.black_level, V2.black_level) == (16, 64)
+
+
+def _write_raw_jpeg(path, bayer, bayer_order, layout):
+    header = bytearray(RAW_HEADER_SIZE)
+    header[:4] = RAW_MAGIC
+    header[RAW_BAYER_ORDER_OFFSET] = bayer_order
+    packed = np.zeros((layout.rows, layout.stride), dtype=np.uint8)
+    packed[: layout.height] = pack_raw10(bayer, layout.stride)
+    path.write_bytes(b"\xff\xd8 jpeg data \xff\xd9" + bytes(header) + packed.tobytes())
+
+
+def _mosaic(planes, pattern):
+    # Inverse of a half resolution demosaic: planes are B, G, R (h/2 x w/2)
+    bgr = dict(zip("BGR", planes))
+    bayer = np.empty((planes.shape[1] * 2, planes.shape[2] * 2), dtype=np.uint16)
+    bayer[0::2, 0::2] = bgr[pattern[0]]
+    bayer[0::2, 1::2] = bgr[pattern[1]]
+    bayer[1::2, 0::2] = bgr[pattern[2]]
+    bayer[1::2, 1::2] = bgr[pattern[3]]
+    return bayer
+
+
+@LAYOUTS
+def test_read_raw_bayer_round_trip(tmp_path, layout):
+    rng = np.random.default_rng(0)
+    bayer = rng.integers(0, RAW_MAX_VALUE + 1, (layout.height, layout.width))
+    path = tmp_path / "raw.jpg"
+    _write_raw_jpeg(path, bayer, bayer_order=3, layout=layout)
+
+    read, read_layout = read_raw_bayer(path)
+    assert read.dtype == np.uint16
+    np.testing.assert_array_equal(read, bayer)
+    assert read_layout.bayer_pattern == "GRBG"
+    assert read_layout.black_level == layout.black_level
+    assert (read_layout.width, read_layout.height) == (layout.width, layout.height)
+
+
+def test_unknown_bayer_order(tmp_path):
+    path = tmp_path / "raw.jpg"
+    _write_raw_jpeg(path, np.zeros((V2.height, V2.width)), bayer_order=7, layout=V2)
+    with pytest.raises(Exception, match="Bayer order"):
+        read_raw_bayer(path)
+
+
+@LAYOUTS
+def test_merge_linear_hdr(tmp_path, layout):
+    # A scene with 8 stops of range, captured at three exposures
+    h, w = layout.height // 2, layout.width // 2
+    radiance = np.geomspace(0.02, 4, w, dtype=np.float32)[np.newaxis, np.newaxis]
+    radiance = radiance * np.array([0.5, 1.0, 0.8], np.float32)[:, None, None]
+    radiance = np.broadcast_to(radiance, (3, h, w))
+
+    exposures = [0.2, 1.0, 5.0]
+    paths = []
+    for i, exposure in enumerate(exposures):
+        signal = np.clip(radiance * exposure, 0, 1)
+        level = layout.black_level + signal * (RAW_MAX_VALUE - layout.black_level)
+        paths.append(tmp_path / f"raw_{i}.jpg")
+        bayer = _mosaic(np.round(level), "BGGR")
+        _write_raw_jpeg(paths[-1], bayer, bayer_order=2, layout=layout)
+
+    hdr = merge_linear_hdr(paths, exposures, awb_gains=(1.0, 1.0))
+    assert hdr.shape == (h, w, 3)
+    rel_err = np.abs(hdr - radiance.transpose(1, 2, 0)) / radiance.transpose(1, 2, 0)
+    assert np.median(rel_err) < 0.005
+    assert rel_err.max() < 0.1
+
+    # Fixed gains scale the red and blue channels, and nothing else
+    balanced = merge_linear_hdr(paths, exposures, awb_gains=(1.25, 2.0))
+    np.testing.assert_allclose(balanced, hdr * [2.0, 1.0, 1.25], rtol=1e-6)
+
+    # Gray world makes the channel means equal
+    means = merge_linear_hdr(paths, exposures, gray_world=True).mean(axis=(0, 1))
+    np.testing.assert_allclose(means, means[1], rtol=1e-3)
@@ -0,0 +1,83 @@
+import cv2
+import numpy as np
+import pytest
+
+from post_processor.stabilization import (
+    FrameTransform,
+    Stabilizer,
+    apply_transform,
+    estimate_transform,
+    read_registration_image,
+)
+
+W, H = 1640, 1232
+
+
+def _scene():
+    # Smooth random texture, like a landscape at 1/8 scale
+    rng = np.random.default_rng(0)
+    noise = rng.random((H // 4, W // 4)).astype(np.float32)
+    img = cv2.GaussianBlur(cv2.resize(noise, (W, H)), (0, 0), 2)
+    img = cv2.normalize(img, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+    return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+
+
+def _drift(img, drift: FrameTransform):
+    # The camera drifted: the inverse of the correction
+    m = cv2.invertAffineTransform(drift.correction_matrix(W, H))
+    return cv2.warpAffine(img, m, (W, H), borderMode=cv2.BORDER_REFLECT)
+
+
+@pytest.fixture
+def frames(tmp_path):
+    reference = _scene()
+    drift = FrameTransform(dx=24.0, dy=-16.0, angle=0.8)
+    frame = _drift(reference, drift)
+    paths = [tmp_path / "reference.jpg", tmp_path / "frame.jpg"]
+    for path, img in zip(paths, [reference, frame]):
+        cv2.imwrite(str(path), img)
+    return paths, drift, reference, frame
+
+
+def test_drift_round_trip(frames):
+    (reference_path, frame_path), drift, reference, frame = frames
+    estimated = estimate_transform(
+        read_registration_image(reference_path), read_registration_image(frame_path)
+    )
+    assert estimated.dx == pytest.approx(drift.dx, abs=0.5)
+    assert estimated.dy == pytest.approx(drift.dy, abs=0.5)
+    assert estimated.angle == pytest.approx(drift.angle, abs=0.02)
+
+    # Correcting the frame brings it back onto the reference
+    corrected = apply_transform(frame, estimated)
+    center = (slice(H // 4, 3 * H // 4), slice(W // 4, 3 * W // 4))
+    before = np.abs(frame[center].astype(int) - reference[center]).mean()
+    after = np.abs(corrected[center].astype(int) - reference[center]).mean()
+    assert after < 2 < before
+
+
+def test_no_drift(frames):
+    (reference_path, _), _, _, _ = frames
+    reference = read_registration_image(reference_path)
+    estimated = estimate_transform(reference, reference)
+    assert abs(estimated.dx) < 0.1 and abs(estimated.dy) < 0.1
+    assert abs(estimated.angle) < 0.01
+
+
+def test_cache(frames, tmp_path):
+    (reference_path, frame_path), _, _, _ = frames
+    cache_path = tmp_path / "processed" / "stabilization.json"
+    stabilizer = Stabilizer(reference_path, cache_path)
+    stabilizer.compute_all([("frame", frame_path), ("reference", reference_path)])
+    assert cache_path.exists()
+
+    # Loaded from the cache, without reading the images again
+    frame_path.unlink()
+    cached = Stabilizer(reference_path, cache_path)
+    assert cached.transforms == stabilizer.transforms
+    assert cached.get_transform("frame", frame_path) == stabilizer.transforms["frame"]
+
+    # Transforms computed against another reference are not used
+    other = Stabilizer(tmp_path / "other.jpg", cache_path)
+    assert other.transforms == {}
+    assert other.reference_key != stabilizer.reference_key
@@ -0,0 +1,193 @@
+import pytest
+
+pytest.importorskip("azure.core")
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceModifiedError
+
+from common import storage
+from common.storage import LocalContainerClient
+
+
+@pytest.fixture
+def local_container(tmp_path, monkeypatch):
+    monkeypatch.setenv("TIMELAPSE_LOCAL_CONTAINER_DIR", str(tmp_path))
+    monkeypatch.setattr(storage, "_indexed_hours", set())
+    return tmp_path
+
+
+def _write_series(root, day, series, shutters):
+    series_dir = root / day / series
+    series_dir.mkdir(parents=True)
+    for shutter in shutters:
+        (series_dir / f"{series}--shutter_{shutter:03d}.jpg").write_bytes(
+            b"x" * shutter
+        )
+
+
+def _upload(local_dir):
+    storage.upload_to_remote_storage(
+        "container",
+        source=str(local_dir),
+        dest="tl/images",
+        delete=True,
+        manifest_prefix="tl/manifests",
+    )
+
+
+def _count_reads(monkeypatch):
+    reads = []
+    read_json_blob = storage._read_json_blob
+
+    def counting_read(client, blob_name):
+        reads.append(blob_name)
+        return read_json_blob(client, blob_name)
+
+    monkeypatch.setattr(storage, "_read_json_blob", counting_read)
+    return reads
+
+
+def test_manifest_round_trip(local_container, tmp_path_factory, monkeypatch):
+    local_dir = tmp_path_factory.mktemp("images")
+    _write_series(local_dir, "2022-05-07", "2022-05-07T06-10-00", [50, 100])
+    _write_series(local_dir, "2022-05-07", "2022-05-07T07-10-00", [100])
+    _write_series(local_dir, "2022-05-08", "2022-05-08T06-10-00", [100, 200])
+    _upload(local_dir)
+    assert not any(p.is_file() for p in local_dir.rglob("*"))
+
+    # Starting 2022-05-08 closed 2022-05-07
+    client = storage._get_container_client("container")
+    index = storage.read_manifest_index(client, "tl/manifests")
+    assert index == {
+        "days": ["2022-05-07", "2022-05-08"],
+        "closed": {"2022-05-07": 1},
+        "complete": True,
+    }
+    manifest = storage.read_day_manifest(client, "tl/manifests", "2022-05-07")
+    assert manifest["closed"]
+    assert manifest["hours"] == ["06", "07"]
+    assert manifest["images_prefix"] == "tl/images"
+    entries = manifest["series"]["2022-05-07T06-10-00"]
+    assert [(x["shutter"], x["size"]) for x in entries] == [(50, 50), (100, 100)]
+    assert list(manifest["series"]) == ["2022-05-07T06-10-00", "2022-05-07T07-10-00"]
+    open_manifest = storage.read_day_manifest(client, "tl/manifests", "2022-05-08")
+    assert "closed" not in open_manifest
+    assert list(open_manifest["series"]) == ["2022-05-08T06-10-00"]
+
+    # Rebuilding from the blob listing gives the same manifests
+    (local_container / "container" / "tl" / "manifests").rename(
+        local_container / "old_manifests"
+    )
+    storage.rebuild_manifests("container", "tl")
+    assert storage.read_manifest_index(client, "tl/manifests") == index
+    assert storage.read_day_manifest(client, "tl/manifests", "2022-05-07") == manifest
+    assert (
+        storage.read_day_manifest(client, "tl/manifests", "2022-05-08") == open_manifest
+    )
+
+    # Download into an empty directory
+    dst_dir = tmp_path_factory.mktemp("download")
+    monkeypatch.setattr(storage.config, "TIMELAPSE_NAME", "tl")
+    assert storage.download_from_manifests("container", "2022-05-08", dst_dir)
+    downloaded = sorted(p.name for p in dst_dir.rglob("*.jpg"))
+    assert downloaded == [
+        "2022-05-08T06-10-00--shutter_100.jpg",
+        "2022-05-08T06-10-00--shutter_200.jpg",
+    ]
+
+
+def test_download_skips_closed_days(local_container, tmp_path_factory, monkeypatch):
+    local_dir = tmp_path_factory.mktemp("images")
+    _write_series(local_dir, "2022-05-07", "2022-05-07T06-10-00", [100])
+    _write_series(local_dir, "2022-05-08", "2022-05-08T06-10-00", [100])
+    _upload(local_dir)
+    monkeypatch.setattr(storage.config, "TIMELAPSE_NAME", "tl")
+    dst_dir = tmp_path_factory.mktemp("download")
+    assert storage.download_from_manifests("container", "", dst_dir)
+    assert len(list(dst_dir.rglob("*.jpg"))) == 2
+
+    # The closed day is not read again. The open day and its hours are.
+    reads = _count_reads(monkeypatch)
+    storage.download_from_manifests("container", "", dst_dir)
+    assert sorted(reads) == [
+        "tl/manifests/2022-05-08.json",
+        "tl/manifests/2022-05-08/06.json",
+        "tl/manifests/index.json",
+    ]
+
+    # A late upload to the closed day bumps its revision, so it is read again
+    monkeypatch.setattr(storage, "_indexed_hours", set())
+    _write_series(local_dir, "2022-05-07", "2022-05-07T23-50-00", [100])
+    _upload(local_dir)
+    client = storage._get_container_client("container")
+    index = storage.read_manifest_index(client, "tl/manifests")
+    assert index["closed"] == {"2022-05-07": 2}
+    storage.download_from_manifests("container", "", dst_dir)
+    assert (dst_dir / "tl/images/2022-05-07/2022-05-07T23-50-00").is_dir()
+
+
+def test_download_falls_back_to_azcopy(local_container, tmp_path_factory, monkeypatch):
+    # Images uploaded before the manifests existed
+    old_image = local_container / "container/tl/images/2022-05-06/2022-05-06T06-10-00"
+    old_image.mkdir(parents=True)
+    (old_image / "2022-05-06T06-10-00--shutter_100.jpg").write_bytes(b"x")
+    local_dir = tmp_path_factory.mktemp("images")
+    _write_series(local_dir, "2022-05-07", "2022-05-07T06-10-00", [100])
+    _upload(local_dir)
+
+    monkeypatch.setattr(storage.config, "TIMELAPSE_NAME", "tl")
+    synced = []
+    monkeypatch.setattr(storage, "sync_files", lambda *args, **kw: synced.append(args))
+    dst_dir = tmp_path_factory.mktemp("download")
+    storage.download_images("container", "", dst_dir)
+    assert len(synced) == 1
+
+    # After a rebuild the manifests list every image
+    monkeypatch.setattr(
+        "sys.argv", ["storage", "rebuild-manifests", "--container", "container"]
+    )
+    monkeypatch.setattr(storage.config, "TIMELAPSE_NAME", "tl")
+    storage.main()
+    storage.download_images("container", "", dst_dir)
+    assert len(synced) == 1
+    assert len(list(dst_dir.rglob("*.jpg"))) == 2
+
+
+def test_etag_conflict(local_container):
+    client = LocalContainerClient(local_container / "container")
+    client.upload_blob(name="a.json", data="1")
+    etag = client.download_blob("a.json").properties.etag
+
+    client.upload_blob(name="a.json", data="2", overwrite=True)
+    with pytest.raises(ResourceModifiedError):
+        client.upload_blob(
+            name="a.json",
+            data="3",
+            overwrite=True,
+            etag=etag,
+            match_condition=MatchConditions.IfNotModified,
+        )
+    assert client.download_blob("a.json").readall() == b"2"
+
+
+def test_concurrent_manifest_update_is_retried(local_container, monkeypatch):
+    # Another writer adds a series between our read and our write
+    client = LocalContainerClient(local_container / "container")
+    read_json_blob = storage._read_json_blob
+    calls = []
+
+    def racing_read(client, blob_name):
+        content = read_json_blob(client, blob_name)
+        if blob_name.endswith("/06.json") and not calls:
+            calls.append(blob_name)
+            storage._update_hour_manifest(
+                client, "m", "2022-05-07", "06", {"2022-05-07T06-00-00": []}
+            )
+        return content
+
+    monkeypatch.setattr(storage, "_read_json_blob", racing_read)
+    storage.update_day_manifest(
+        client, "m", "images", "2022-05-07", {"2022-05-07T06-10-00": []}
+    )
+    series = storage.read_hour_manifest(client, "m", "2022-05-07", "06")
+    assert sorted(series) == ["2022-05-07T06-00-00", "2022-05-07T06-10-00"]